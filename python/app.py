@@ -1,6 +1,9 @@
 from fastapi import FastAPI
 
-from routers import fits, raw, xisf, image, forecast
+from routers import fits, raw, xisf, image, forecast, headers, tiles
+from services.memory_budget import MEMORY_BUDGET
+from services.raw_service import RAW_CACHE
+from services.thumb_cache import THUMB_CACHE
 
 app = FastAPI(title="Astropy FITS helper")
 
@@ -10,8 +13,19 @@ def health():
     return {"status": "ok"}
 
 
+@app.get("/metrics")
+def metrics():
+    return {
+        "thumbnail_cache": THUMB_CACHE.snapshot(),
+        "raw_decode_cache": RAW_CACHE.snapshot(),
+        "decode_memory": MEMORY_BUDGET.snapshot(),
+    }
+
+
 app.include_router(fits.router)
 app.include_router(raw.router)
 app.include_router(xisf.router)
 app.include_router(image.router)
 app.include_router(forecast.router)
+app.include_router(headers.router)
+app.include_router(tiles.router)
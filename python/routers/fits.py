@@ -1,66 +1,116 @@
 import io
 import numpy as np
 from astropy.io import fits
-from fastapi import APIRouter, Query
-from fastapi.responses import JSONResponse, Response
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from PIL import Image
 
-from services.fits_service import first_image_hdu, to_js9_safe_hdu
-from services.stretch import _percentile_asinh_8bit, resize_keep_ratio
+from services.fits_service import (
+    bayer_pattern, first_image_hdu, fits_working_set, js9_safe_stream, read_fits_header, read_fits_preview,
+    superpixel_debayer, to_js9_safe_hdu,
+)
+from services.image_encode import OutputFormat, output_format
+from services.memory_budget import MEMORY_BUDGET
+from services.precision import working_array
+from services.stf import STATS_SAMPLE_WIDTH, cached_channel_stats
+from services.stretch import render_thumbnail
+from services.thumb_cache import cached_render_response
 from utils.path_guard import require_safe_path
-from PIL import Image
 
 router = APIRouter()
 
 
-@router.get("/fits/header")
-def fits_header(path: str):
-    p = require_safe_path(path)
+def _fits_header(p, path: str) -> dict:
     try:
-        with fits.open(str(p), memmap=False, ignore_missing_end=True) as hdul:
-            hdu = first_image_hdu(hdul) or hdul[0]
-            hdr = {k: (str(v) if not isinstance(v, (int, float, str)) else v)
-                   for k, v in hdu.header.items()}
-        return JSONResponse(hdr)
+        return {k: (str(v) if not isinstance(v, (int, float, str)) else v)
+                for k, v in read_fits_header(str(p)).items()}
     except Exception as e:
-        from fastapi import HTTPException
         raise HTTPException(status_code=400, detail=str(e))
 
 
+@router.get("/fits/header")
+def fits_header(path: str):
+    p = require_safe_path(path)
+    return JSONResponse(_fits_header(p, path))
+
+
 @router.get("/fits/thumbnail")
-def fits_thumbnail(path: str, w: int = 512):
+def fits_thumbnail(path: str, w: int = 512, decimate: str = "mean", debayer: bool = True,
+                   plane: int = 0, rgb: bool = False, stretch: str = "asinh", linked: bool = True,
+                   out: OutputFormat = Depends(output_format)):
+    """
+    `plane` selects one plane of a cube; `rgb` renders planes 0-2 of a cube as colour.
+    `stretch` is 'asinh' (percentile) or 'stf' (auto-STF, `linked` or per channel).
+    """
     p = require_safe_path(path)
+    planes = (0, 1, 2) if rgb else plane
+
+    def stats_sample(data):
+        sample = read_fits_preview(str(p), STATS_SAMPLE_WIDTH, mode="stride", debayer=debayer, planes=planes)
+        return data if sample is None else sample
+
+    def render() -> Image.Image:
+        data = read_fits_preview(str(p), w, mode=decimate, debayer=debayer, planes=planes)
+        if data is not None:
+            return finish(data)
+        with MEMORY_BUDGET.reserve(fits_working_set(str(p)), "FITS decode"):
+            with fits.open(str(p), memmap=False, ignore_missing_end=True) as hdul:
+                hdu = first_image_hdu(hdul)
+                if hdu is None or hdu.data is None:
+                    raise HTTPException(status_code=400, detail="No image data")
+                data = working_array(hdu.data)
+                cube = data.reshape(-1, *data.shape[-2:])
+                if rgb:
+                    if cube.shape[0] < 3:
+                        raise ValueError("rgb=true needs a cube with at least 3 planes")
+                    data = np.moveaxis(cube[:3], 0, -1)
+                else:
+                    if not 0 <= plane < cube.shape[0]:
+                        raise ValueError(f"Plane {plane} out of range (image has {cube.shape[0]} planes)")
+                    data = cube[plane]
+                    pattern = bayer_pattern(hdu.header) if debayer else None
+                    if pattern:
+                        data = superpixel_debayer(data, pattern)
+            return finish(data)
+
+    def finish(data) -> Image.Image:
+        stats = None
+        if stretch == "stf":
+            stats = cached_channel_stats(p, "fits", lambda: stats_sample(data),
+                                         plane=plane, rgb=rgb, debayer=debayer)
+        im = render_thumbnail(data, w, stretch, linked=linked, stats=stats)
+        return im
+
     try:
-        with fits.open(str(p), memmap=False, ignore_missing_end=True) as hdul:
-            hdu = first_image_hdu(hdul)
-            if hdu is None or hdu.data is None:
-                from fastapi import HTTPException
-                raise HTTPException(status_code=400, detail="No image data")
-            data = np.asarray(hdu.data, dtype=np.float64)
-            if data.ndim > 2:
-                data = data[0]
-            img8 = _percentile_asinh_8bit(data)
-            im = resize_keep_ratio(Image.fromarray(img8), w)
-            buf = io.BytesIO()
-            im.save(buf, format="PNG")
-            return Response(content=buf.getvalue(), media_type="image/png")
+        return cached_render_response(p, "fits", render, out, w=w, decimate=decimate, debayer=debayer,
+                                     plane=plane, rgb=rgb, stretch=stretch, linked=linked)
+    except HTTPException:
+        raise
     except Exception as e:
-        from fastapi import HTTPException
         raise HTTPException(status_code=400, detail=str(e))
 
 
 @router.get("/js9safe")
-def js9safe(path: str = Query(..., description="Path to FITS")):
+def js9safe(path: str = Query(..., description="Path to FITS"),
+            plane: int = Query(0, description="Plane of a cube to convert")):
     p = require_safe_path(path)
     try:
-        with fits.open(str(p), memmap=False, ignore_missing_end=True) as hdul:
-            hdu = first_image_hdu(hdul)
-            if hdu is None or hdu.data is None:
-                from fastapi import HTTPException
-                raise HTTPException(status_code=400, detail="No image data in FITS")
-            safe = to_js9_safe_hdu(hdu)
-            buf = io.BytesIO()
-            fits.HDUList([safe]).writeto(buf, overwrite=True, output_verify="silentfix")
-            return Response(content=buf.getvalue(), media_type="application/octet-stream")
+        plan = js9_safe_stream(str(p), plane)
+        if plan is not None:
+            length, body = plan
+            return StreamingResponse(body, media_type="application/octet-stream",
+                                     headers={"Content-Length": str(length)})
+
+        with MEMORY_BUDGET.reserve(fits_working_set(str(p)), "FITS decode"):
+            with fits.open(str(p), memmap=False, ignore_missing_end=True) as hdul:
+                hdu = first_image_hdu(hdul)
+                if hdu is None or hdu.data is None:
+                    raise HTTPException(status_code=400, detail="No image data in FITS")
+                safe = to_js9_safe_hdu(hdu, plane)
+                buf = io.BytesIO()
+                fits.HDUList([safe]).writeto(buf, overwrite=True, output_verify="silentfix")
+                return Response(content=buf.getvalue(), media_type="application/octet-stream")
+    except HTTPException:
+        raise
     except Exception as e:
-        from fastapi import HTTPException
         raise HTTPException(status_code=400, detail=str(e))
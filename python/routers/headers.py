@@ -0,0 +1,104 @@
+import json
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import partial
+from pathlib import Path
+from typing import List, Optional
+
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+
+from routers.fits import _fits_header
+from routers.image import _image_header, ALLOWED_IMAGE_EXTS
+from routers.raw import _raw_header, RAW_EXTENSIONS
+from routers.xisf import _xisf_header
+from services.fits_service import FITS_EXTENSIONS
+from utils.json_utils import _json_safe
+from utils.path_guard import require_safe_path
+
+router = APIRouter()
+
+# Worker threads shared by all batch calls (header reads are mostly I/O waits on the NAS),
+# so concurrent batches queue for the same workers instead of multiplying NAS load
+MAX_BATCH_WORKERS = int(os.environ.get("HEADERS_BATCH_WORKERS", min(32, (os.cpu_count() or 1) * 4)))
+_BATCH_POOL = ThreadPoolExecutor(max_workers=MAX_BATCH_WORKERS, thread_name_prefix="headers")
+
+
+class HeadersBatchRequest(BaseModel):
+    paths: List[str]
+    workers: Optional[int] = None
+    exif: bool = False      # RAW files: include the full EXIF tag dump
+
+
+def _header_extractor(p: Path, exif: bool = False):
+    """Return (format, extractor) for a file, dispatched on its extension."""
+    ext = p.suffix.lower()
+    if ext in FITS_EXTENSIONS:
+        return "fits", _fits_header
+    if ext in RAW_EXTENSIONS:
+        return "raw", partial(_raw_header, exif=exif)
+    if ext == ".xisf":
+        return "xisf", _xisf_header
+    if ext in ALLOWED_IMAGE_EXTS:
+        return "image", _image_header
+    raise HTTPException(status_code=415, detail=f"Unsupported format ({ext or 'no extension'})")
+
+
+def _raw_only_extractor(p: Path, exif: bool = False):
+    if p.suffix.lower() not in RAW_EXTENSIONS:
+        raise HTTPException(status_code=415, detail=f"Not a camera RAW file ({p.suffix.lower() or 'no extension'})")
+    return _header_extractor(p, exif)
+
+
+def _extract_one(path: str, dispatch=_header_extractor, exif: bool = False) -> dict:
+    """Extract one header; errors are returned inline instead of raised."""
+    fmt = None
+    try:
+        p = require_safe_path(path)
+        fmt, extractor = dispatch(p, exif)
+        return {"path": path, "ok": True, "format": fmt, "header": _json_safe(extractor(p, path))}
+    except HTTPException as e:
+        return {"path": path, "ok": False, "format": fmt, "status": e.status_code, "error": str(e.detail)}
+    except Exception as e:
+        return {"path": path, "ok": False, "format": fmt, "status": 500, "error": str(e)}
+
+
+@router.post("/headers/batch")
+def headers_batch(req: HeadersBatchRequest):
+    """
+    Extract headers of many files in one call.
+    Streams NDJSON: one line per file, in completion order (not request order).
+    """
+    return _stream_batch(req, _header_extractor)
+
+
+@router.post("/raw/header/batch")
+def raw_header_batch(req: HeadersBatchRequest):
+    """As /headers/batch for camera RAW files only (others are reported with status 415)."""
+    return _stream_batch(req, _raw_only_extractor)
+
+
+def _stream_batch(req: HeadersBatchRequest, dispatch) -> StreamingResponse:
+    # Files of one batch in flight at a time on the shared pool
+    workers = max(1, min(req.workers or MAX_BATCH_WORKERS, MAX_BATCH_WORKERS, len(req.paths) or 1))
+
+    def stream():
+        paths = iter(req.paths)
+        running = set()
+        try:
+            while True:
+                for path in paths:
+                    running.add(_BATCH_POOL.submit(_extract_one, path, dispatch, req.exif))
+                    if len(running) >= workers:
+                        break
+                if not running:
+                    return
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    yield json.dumps(fut.result(), default=str) + "\n"
+        finally:
+            for fut in running:
+                fut.cancel()
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
@@ -1,15 +1,22 @@
-import io
+import json
+import math
 import os
+import threading
 import traceback
+from collections import OrderedDict
 from datetime import datetime
+from pathlib import Path
 
 import tifffile as tiff
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Depends, HTTPException
 from fastapi.responses import JSONResponse, Response
 from PIL import Image, ExifTags, TiffImagePlugin, TiffTags, ImageFile
 
-from services.stretch import to_rgb_image, resize_keep_ratio
-from services.tiff_service import open_tiff_as_image, _sniff_tiff_magic
+from services.image_encode import OutputFormat, output_format
+from services.memory_budget import MEMORY_BUDGET
+from services.stretch import REDUCING_GAP, resize_keep_ratio
+from services.thumb_cache import cached_render_response
+from services.tiff_service import open_tiff_as_image, _is_tiff_prefix
 from utils.path_guard import require_safe_path
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
@@ -22,6 +29,19 @@ router = APIRouter()
 
 ALLOWED_IMAGE_EXTS = {".jpg", ".jpeg", ".png", ".tif", ".tiff"}
 
+# Header payloads memoised per file version: re-scanning an unchanged folder costs one
+# stat per file. Bounded by count and by bytes (each entry weighed as its JSON
+# encoding: EXIF/TIFF tag dumps, MakerNotes included, can run to hundreds of KiB).
+HEADER_CACHE_ENTRIES = int(os.environ.get("IMAGE_HEADER_CACHE_ENTRIES", 4096))
+HEADER_CACHE_BYTES = int(os.environ.get("IMAGE_HEADER_CACHE_BYTES", 32 * 1024 * 1024))
+# Read buffer of the single open: the first read pulls in this much, the format is
+# sniffed from it and Pillow/tifffile usually find every header inside it.
+HEADER_PREFIX_BYTES = 64 * 1024
+
+_HEADERS = OrderedDict()    # (path, size, mtime) → (payload without "path", its size in bytes)
+_HEADERS_BYTES = 0
+_HEADERS_LOCK = threading.Lock()
+
 
 def _sanitize_tag_value(value):
     """Make a TIFF tag value JSON-serializable."""
@@ -121,42 +141,76 @@ def _build_tiff_summary(tiff_tags: dict) -> dict:
 
 
 @router.get("/image/thumbnail")
-def image_thumbnail(path: str, w: int = 512):
+def image_thumbnail(path: str, w: int = 512, upscale: bool = True, out: OutputFormat = Depends(output_format)):
+    """
+    Thumbnail `w` wide. Narrower sources are enlarged to `w` (what the gallery previews
+    are laid out for) unless `upscale=false`, which keeps them at their own width.
+    A source already at the resulting width and stored in the requested format is
+    returned byte for byte, without re-encoding.
+    """
     p = require_safe_path(path)
     ext = p.suffix.lower()
     if ext not in {".jpg", ".jpeg", ".png"}:
         raise HTTPException(status_code=415, detail="Unsupported format (expecting .jpg, .jpeg, or .png)")
+    if w <= 0:
+        raise HTTPException(status_code=400, detail="Width 'w' must be > 0")
 
     try:
-        im = Image.open(str(p))
+        with Image.open(str(p)) as im:
+            passthrough = (im.width == w or (im.width < w and not upscale)) \
+                and (im.format or "").lower() == out.name
+            need = _image_working_set(im)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to open image: {str(e)}")
+    if passthrough:
+        resp = Response(content=p.read_bytes(), media_type=out.media_type, headers={"X-Thumb-Cache": "passthrough"})
+        if out.negotiated:
+            resp.headers["Vary"] = "Accept"
+        return resp
+
+    def render() -> Image.Image:
+        with MEMORY_BUDGET.reserve(need, "image decode"):
+            try:
+                im = Image.open(str(p))
+                if im.mode in ("1", "P"):
+                    im = im.convert("RGB")
+                # Two-stage: draft()/reduce() to within REDUCING_GAP × the target, then LANCZOS.
+                # The height bound is rounded up so it never constrains the width.
+                im.thumbnail((w, math.ceil(im.height * w / im.width)), Image.LANCZOS, reducing_gap=REDUCING_GAP)
+                if upscale and im.width < w:
+                    im = resize_keep_ratio(im, w)
+            except Exception as e:
+                raise HTTPException(status_code=500, detail=f"Failed to open image: {str(e)}")
 
-    im = resize_keep_ratio(im, w)
-    if im.mode != "RGB":
-        im = im.convert("RGB")
+            if im.mode != "RGB":
+                im = im.convert("RGB")
 
-    buf = io.BytesIO()
-    im.save(buf, format="PNG")
-    buf.seek(0)
-    return Response(content=buf.getvalue(), media_type="image/png")
+        return im
+
+    return cached_render_response(p, "image", render, out, w=w, upscale=upscale)
+
+
+def _image_working_set(im: Image.Image) -> int:
+    """Estimated bytes to decode the opened JPEG/PNG `im` at full size and convert it (see services.memory_budget)."""
+    bands = len(im.getbands())
+    itemsize = 4 if im.mode in ("I", "F") else 2 if im.mode.startswith("I;16") else 1
+    return im.width * im.height * bands * itemsize * 2
 
 
 @router.get("/tif/thumbnail")
-def tif_thumbnail(path: str, w: int = 512):
+def tif_thumbnail(path: str, w: int = 512, stretch: str = "asinh", linked: bool = True,
+                  out: OutputFormat = Depends(output_format)):
     p = require_safe_path(path)
     if p.suffix.lower() not in {".tif", ".tiff"}:
         raise HTTPException(status_code=415, detail="Unsupported format (expecting .tif/.tiff)")
     if w <= 0:
         raise HTTPException(status_code=400, detail="Width 'w' must be > 0")
 
+    def render() -> Image.Image:
+        return open_tiff_as_image(str(p), w, stretch, linked)
+
     try:
-        im = open_tiff_as_image(str(p))
-        im = resize_keep_ratio(im, w)
-        buf = io.BytesIO()
-        im.save(buf, format="PNG")
-        buf.seek(0)
-        return Response(content=buf.getvalue(), media_type="image/png")
+        return cached_render_response(p, "tif", render, out, w=w, stretch=stretch, linked=linked)
     except HTTPException:
         raise
     except Exception as e:
@@ -164,144 +218,183 @@ def tif_thumbnail(path: str, w: int = 512):
         raise HTTPException(status_code=500, detail=f"Unexpected TIFF error: {str(e)}")
 
 
-@router.get("/image/header")
-def image_header(path: str):
-    p = require_safe_path(path)
+def _image_header(p: Path, path: str) -> dict:
     ext = p.suffix.lower()
     if ext not in ALLOWED_IMAGE_EXTS:
         raise HTTPException(415, "Unsupported format (jpg, jpeg, png, tif, tiff)")
-
     try:
-        with Image.open(str(p)) as im:
-            payload = {
-                "path": path,
-                "format": im.format,
-                "mime": Image.MIME.get(im.format, "application/octet-stream"),
-                "mode": im.mode,
-                "width": im.width,
-                "height": im.height,
-                "size": f"{im.width}x{im.height}",
-                "frames": getattr(im, "n_frames", 1),
-                "animated": bool(getattr(im, "is_animated", False)),
-                "has_palette": im.palette is not None,
-            }
-
-            info = {}
-            if "dpi" in im.info:
-                dpi = im.info["dpi"]
-                if isinstance(dpi, (tuple, list)) and len(dpi) == 2:
-                    info["dpi_x"], info["dpi_y"] = _sanitize_tag_value(dpi[0]), _sanitize_tag_value(dpi[1])
-                else:
-                    info["dpi"] = _sanitize_tag_value(dpi)
-            if "icc_profile" in im.info:
-                icc = im.info["icc_profile"]
-                info["icc_profile"] = {"present": True, "bytes": len(icc) if isinstance(icc, (bytes, bytearray)) else 0}
-            if "compression" in im.info:
-                info["compression"] = im.info["compression"]
-            if info:
-                payload["info"] = info
-
-            exif_map = {}
+        st = os.stat(str(p))
+    except OSError as e:
+        raise HTTPException(status_code=500, detail=f"Failed to read headers: {e}")
+
+    key = (str(p), st.st_size, st.st_mtime_ns)
+    with _HEADERS_LOCK:
+        entry = _HEADERS.get(key)
+        if entry is not None:
+            _HEADERS.move_to_end(key)
+    if entry is not None:
+        return {"path": path, **entry[0]}
+
+    payload = _read_image_header(p, ext, st)
+    _cache_header(key, payload)
+    return {"path": path, **payload}
+
+
+def _cache_header(key: tuple, payload: dict):
+    global _HEADERS_BYTES
+    size = len(json.dumps(payload, default=str))
+    if size > HEADER_CACHE_BYTES:
+        return
+    with _HEADERS_LOCK:
+        old = _HEADERS.pop(key, None)
+        if old is not None:
+            _HEADERS_BYTES -= old[1]
+        _HEADERS[key] = (payload, size)
+        _HEADERS_BYTES += size
+        while len(_HEADERS) > HEADER_CACHE_ENTRIES or _HEADERS_BYTES > HEADER_CACHE_BYTES:
+            _, (_, evicted) = _HEADERS.popitem(last=False)
+            _HEADERS_BYTES -= evicted
+
+
+def _file_info(st: os.stat_result) -> dict:
+    return {
+        "size_bytes": st.st_size,
+        "modified": datetime.fromtimestamp(st.st_mtime).isoformat(),
+        "created": datetime.fromtimestamp(st.st_ctime).isoformat(),
+    }
+
+
+def _read_image_header(p: Path, ext: str, st: os.stat_result) -> dict:
+    """Header payload (without "path") from a single open of the file."""
+    try:
+        f = open(str(p), "rb", buffering=HEADER_PREFIX_BYTES)
+    except OSError as e:
+        raise HTTPException(status_code=500, detail=f"Failed to read headers: {e}")
+    with f:
+        is_tiff = _is_tiff_prefix(f.peek(4)[:4])
+        try:
+            return _pillow_header(f, st)
+        except Exception as e_pillow:
+            if not (ext in {".tif", ".tiff"} or is_tiff):
+                raise HTTPException(status_code=500, detail=f"Failed to read headers: {e_pillow}")
             try:
-                exif = im.getexif()
-                if exif:
-                    for tag_id, value in exif.items():
-                        tag = ExifTags.TAGS.get(tag_id, str(tag_id))
-                        exif_map[tag] = _sanitize_tag_value(value)
-            except Exception:
-                pass
-            if exif_map:
-                payload["exif"] = exif_map
-
-            if isinstance(im, TiffImagePlugin.TiffImageFile):
-                try:
-                    raw_tags = {}
-                    for tag, value in im.tag_v2.items():
-                        tag_info = TiffTags.TAGS_V2.get(tag)
-                        tag_name = tag_info.name if tag_info else str(tag)
-                        raw_tags[tag_name] = _sanitize_tag_value(value)
-                    if raw_tags:
-                        payload["tiff_summary"] = _build_tiff_summary(raw_tags)
-                        payload["tiff_tags"] = {
-                            k: v for k, v in raw_tags.items()
-                            if k not in _TIFF_TAGS_EXCLUDE
-                        }
-                except Exception:
-                    pass
+                f.seek(0)
+                return _tifffile_header(f, st)
+            except Exception as e_tiff:
+                raise HTTPException(
+                    status_code=500,
+                    detail=f"Failed to read TIFF headers (Pillow: {e_pillow}; tifffile: {e_tiff})",
+                )
 
+
+def _pillow_header(f, st: os.stat_result) -> dict:
+    with Image.open(f) as im:
+        payload = {
+            "format": im.format,
+            "mime": Image.MIME.get(im.format, "application/octet-stream"),
+            "mode": im.mode,
+            "width": im.width,
+            "height": im.height,
+            "size": f"{im.width}x{im.height}",
+            "frames": getattr(im, "n_frames", 1),
+            "animated": bool(getattr(im, "is_animated", False)),
+            "has_palette": im.palette is not None,
+        }
+
+        info = {}
+        if "dpi" in im.info:
+            dpi = im.info["dpi"]
+            if isinstance(dpi, (tuple, list)) and len(dpi) == 2:
+                info["dpi_x"], info["dpi_y"] = _sanitize_tag_value(dpi[0]), _sanitize_tag_value(dpi[1])
+            else:
+                info["dpi"] = _sanitize_tag_value(dpi)
+        if "icc_profile" in im.info:
+            icc = im.info["icc_profile"]
+            info["icc_profile"] = {"present": True, "bytes": len(icc) if isinstance(icc, (bytes, bytearray)) else 0}
+        if "compression" in im.info:
+            info["compression"] = im.info["compression"]
+        if info:
+            payload["info"] = info
+
+        exif_map = {}
         try:
-            st = os.stat(str(p))
-            payload["file"] = {
-                "size_bytes": st.st_size,
-                "modified": datetime.fromtimestamp(st.st_mtime).isoformat(),
-                "created": datetime.fromtimestamp(st.st_ctime).isoformat(),
-            }
+            exif = im.getexif()
+            if exif:
+                for tag_id, value in exif.items():
+                    tag = ExifTags.TAGS.get(tag_id, str(tag_id))
+                    exif_map[tag] = _sanitize_tag_value(value)
         except Exception:
             pass
+        if exif_map:
+            payload["exif"] = exif_map
 
-        return JSONResponse(payload)
-
-    except Exception as e_pillow:
-        if ext in {".tif", ".tiff"} or _sniff_tiff_magic(str(p)):
+        if isinstance(im, TiffImagePlugin.TiffImageFile):
             try:
-                with tiff.TiffFile(str(p)) as tf:
-                    page = tf.pages[0]
-                    payload = {
-                        "path": path,
-                        "format": "TIFF",
-                        "mime": "image/tiff",
-                        "mode": str(page.dtype),
-                        "width": page.shape[-1],
-                        "height": page.shape[-2],
-                        "size": f"{page.shape[-1]}x{page.shape[-2]}",
-                        "frames": len(tf.pages),
-                        "animated": len(tf.pages) > 1,
-                        "has_palette": bool(getattr(page, "colormap", None)),
+                raw_tags = {}
+                for tag, value in im.tag_v2.items():
+                    tag_info = TiffTags.TAGS_V2.get(tag)
+                    tag_name = tag_info.name if tag_info else str(tag)
+                    raw_tags[tag_name] = _sanitize_tag_value(value)
+                if raw_tags:
+                    payload["tiff_summary"] = _build_tiff_summary(raw_tags)
+                    payload["tiff_tags"] = {
+                        k: v for k, v in raw_tags.items()
+                        if k not in _TIFF_TAGS_EXCLUDE
                     }
+            except Exception:
+                pass
 
-                    res = {}
-                    xres = page.tags.get("XResolution")
-                    yres = page.tags.get("YResolution")
-                    resunit = page.tags.get("ResolutionUnit")
-                    if xres and yres:
-                        try:
-                            def _num(v):
-                                return float(v[0] / v[1]) if hasattr(v, "__len__") and len(v) == 2 else float(v)
-                            res["dpi_x"] = _num(xres.value)
-                            res["dpi_y"] = _num(yres.value)
-                        except Exception:
-                            pass
-                    if resunit:
-                        res["resolution_unit"] = resunit.value
-                    if res:
-                        payload["resolution"] = res
-
-                    raw_tags = {}
-                    for tag in page.tags.values():
-                        raw_tags[tag.name] = _sanitize_tag_value(tag.value)
-                    if raw_tags:
-                        payload["tiff_summary"] = _build_tiff_summary(raw_tags)
-                        payload["tiff_tags"] = {
-                            k: v for k, v in raw_tags.items()
-                            if k not in _TIFF_TAGS_EXCLUDE
-                        }
-
-                try:
-                    st = os.stat(str(p))
-                    payload["file"] = {
-                        "size_bytes": st.st_size,
-                        "modified": datetime.fromtimestamp(st.st_mtime).isoformat(),
-                        "created": datetime.fromtimestamp(st.st_ctime).isoformat(),
-                    }
-                except Exception:
-                    pass
+    payload["file"] = _file_info(st)
+    return payload
+
+
+def _tifffile_header(f, st: os.stat_result) -> dict:
+    with tiff.TiffFile(f) as tf:
+        page = tf.pages[0]
+        payload = {
+            "format": "TIFF",
+            "mime": "image/tiff",
+            "mode": str(page.dtype),
+            "width": page.shape[-1],
+            "height": page.shape[-2],
+            "size": f"{page.shape[-1]}x{page.shape[-2]}",
+            "frames": len(tf.pages),
+            "animated": len(tf.pages) > 1,
+            "has_palette": bool(getattr(page, "colormap", None)),
+        }
+
+        res = {}
+        xres = page.tags.get("XResolution")
+        yres = page.tags.get("YResolution")
+        resunit = page.tags.get("ResolutionUnit")
+        if xres and yres:
+            try:
+                def _num(v):
+                    return float(v[0] / v[1]) if hasattr(v, "__len__") and len(v) == 2 else float(v)
+                res["dpi_x"] = _num(xres.value)
+                res["dpi_y"] = _num(yres.value)
+            except Exception:
+                pass
+        if resunit:
+            res["resolution_unit"] = resunit.value
+        if res:
+            payload["resolution"] = res
+
+        raw_tags = {}
+        for tag in page.tags.values():
+            raw_tags[tag.name] = _sanitize_tag_value(tag.value)
+        if raw_tags:
+            payload["tiff_summary"] = _build_tiff_summary(raw_tags)
+            payload["tiff_tags"] = {
+                k: v for k, v in raw_tags.items()
+                if k not in _TIFF_TAGS_EXCLUDE
+            }
 
-                return JSONResponse(payload)
+    payload["file"] = _file_info(st)
+    return payload
 
-            except Exception as e_tiff:
-                raise HTTPException(
-                    status_code=500,
-                    detail=f"Failed to read TIFF headers (Pillow: {e_pillow}; tifffile: {e_tiff})",
-                )
-        else:
-            raise HTTPException(status_code=500, detail=f"Failed to read headers: {e_pillow}")
+
+@router.get("/image/header")
+def image_header(path: str):
+    p = require_safe_path(path)
+    return JSONResponse(_image_header(p, path))
@@ -3,14 +3,20 @@ from datetime import datetime, timezone
 from fractions import Fraction
 from pathlib import Path
 
-import exifread
 import numpy as np
 import rawpy
-from fastapi import APIRouter, HTTPException
-from fastapi.responses import JSONResponse, Response
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import JSONResponse
 from PIL import Image, ImageOps
 
-from services.stretch import resize_keep_ratio, stretch_channel
+from services.image_encode import OutputFormat, output_format
+from services.raw_exif import read_raw_exif
+from services.raw_service import (
+    RAW_DECODE_MODES, bin_histogram, cached_bayer_histograms, histogram_stats, preview_rgb,
+)
+from services.stf import cached_channel_stats
+from services.stretch import open_near_width, render_thumbnail, resize_keep_ratio
+from services.thumb_cache import cached_render_response
 from utils.path_guard import require_safe_path
 
 router = APIRouter()
@@ -28,37 +34,61 @@ def _detect_format(p: Path) -> str:
 
 
 @router.get("/raw/render")
-def raw_render(path: str, w: int = 1920, stretch: str = "asinh", bp: float = 0.1, wp: float = 99.9):
+def raw_render(path: str, w: int = 1920, stretch: str = "asinh", bp: float = 0.1, wp: float = 99.9,
+               linked: bool = True, decode: str = "auto", out: OutputFormat = Depends(output_format)):
+    """
+    stretch: 'linear' | 'sqrt' | 'log' | 'asinh' between the bp/wp percentiles, or 'stf'
+    for the auto screen transfer function (`linked` across channels or per channel).
+    decode: 'auto' | 'ahd' | 'superpixel' (see services.raw_service.RAW_DECODE_MODES)
+    """
     p = require_safe_path(path)
-    try:
-        with rawpy.imread(str(p)) as raw:
-            rgb = raw.postprocess(
-                output_bps=8, use_camera_wb=True, no_auto_bright=True,
-                gamma=(1, 1),
-                half_size=True, demosaic_algorithm=rawpy.DemosaicAlgorithm.AHD,
-            )
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to decode RAW: {str(e)}")
-    r = stretch_channel(rgb[:, :, 0].astype(np.float32), stretch, bp, wp)
-    g = stretch_channel(rgb[:, :, 1].astype(np.float32), stretch, bp, wp)
-    b = stretch_channel(rgb[:, :, 2].astype(np.float32), stretch, bp, wp)
-    im = resize_keep_ratio(Image.fromarray(np.stack([r, g, b], axis=2)), w)
-    buf = io.BytesIO()
-    im.save(buf, format="PNG")
-    buf.seek(0)
-    return Response(content=buf.getvalue(), media_type="image/png")
+    _check_decode_mode(decode)
+
+    def render() -> Image.Image:
+        try:
+            rgb, mode = preview_rgb(p, w, decode)
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Failed to decode RAW: {str(e)}")
+        stats = None
+        if stretch == "stf":
+            stats = cached_channel_stats(p, "raw_render", lambda: rgb, decode=mode)
+        return render_thumbnail(rgb, w, stretch, bp, wp, linked=linked, stats=stats)
+
+    return cached_render_response(p, "raw_render", render, out, w=w, stretch=stretch, bp=bp, wp=wp,
+                                 linked=linked, decode=decode)
+
+
+def _check_decode_mode(decode: str):
+    if decode not in RAW_DECODE_MODES:
+        raise HTTPException(status_code=400,
+                            detail=f"Unknown decode mode '{decode}' (expecting {', '.join(RAW_DECODE_MODES)})")
+
+
+HIST_MAX_BINS = 1 << 16
 
 
 @router.get("/raw/histogram")
-def raw_histogram(path: str):
+def raw_histogram(path: str, decode: str = "ahd", mode: str = "preview",
+                  bins: int = 256, log: bool = False):
+    """
+    mode=preview: 256-bin r/g/b histograms of the 8-bit preview decode (`decode` as for
+    /raw/render; the default 'ahd' is the colour-managed LibRaw decode).
+    mode=bayer: histograms of the native sensor values per CFA colour (both green
+    sites in g) over [0, white level] in `bins` linear or `log` bins, plus per-colour
+    median, MAD and clipped percentages in raw ADU.
+    """
     p = require_safe_path(path)
+    if mode == "bayer":
+        return _bayer_histogram(p, bins, log)
+    if mode != "preview":
+        raise HTTPException(status_code=400, detail=f"Unknown histogram mode '{mode}' (expecting preview or bayer)")
+    _check_decode_mode(decode)
     try:
-        with rawpy.imread(str(p)) as raw:
-            rgb = raw.postprocess(
-                output_bps=8, use_camera_wb=True, no_auto_bright=True,
-                gamma=(1, 1), half_size=True,
-                demosaic_algorithm=rawpy.DemosaicAlgorithm.AHD,
-            )
+        rgb, _ = preview_rgb(p, None, decode)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to decode RAW: {str(e)}")
 
@@ -69,13 +99,32 @@ def raw_histogram(path: str):
     return JSONResponse({"r": hist(rgb[:, :, 0]), "g": hist(rgb[:, :, 1]), "b": hist(rgb[:, :, 2])})
 
 
-@router.get("/raw/header")
-def raw_header(path: str):
-    p = require_safe_path(path)
+def _bayer_histogram(p: Path, bins: int, log: bool) -> JSONResponse:
+    if not 1 <= bins <= HIST_MAX_BINS:
+        raise HTTPException(status_code=400, detail=f"'bins' must be between 1 and {HIST_MAX_BINS}")
+    try:
+        counts, black, white = cached_bayer_histograms(p)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to read RAW: {str(e)}")
+
+    result = {"mode": "bayer", "bins": bins, "log": log, "black_level": black, "white_level": white, "stats": {}}
+    for c, name in enumerate("rgb"):
+        edges, binned = bin_histogram(counts[c], white, bins, log)
+        result["edges"] = edges.tolist()
+        result[name] = binned.tolist()
+        result["stats"][name] = histogram_stats(counts[c], black[c], white)
+    return JSONResponse(result)
+
+
+def _raw_header(p: Path, path: str, exif: bool = False) -> dict:
+    """Normalised header fields; `exif` adds the full tag dump under "EXIF"."""
     fmt = _detect_format(p)
     try:
-        with open(str(p), "rb") as f:
-            tags = exifread.process_file(f, details=False)
+        tags = read_raw_exif(p, full=exif)
 
         def get(tag, default=None):
             v = tags.get(tag)
@@ -138,51 +187,56 @@ def raw_header(path: str):
             "WB":        get("EXIF WhiteBalance"),
             "METERING":  get("EXIF MeteringMode"),
             "SOFTWARE":  get("Image Software"),
-            "EXIF":      {k: str(v) for k, v in tags.items()},
         }
-        return JSONResponse(payload)
+        if exif:
+            payload["EXIF"] = {k: str(v) for k, v in tags.items()}
+        return payload
 
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Failed to read {fmt} EXIF: {str(e)}")
 
 
-@router.get("/raw/thumbnail")
-def raw_thumbnail(path: str, w: int = 512):
+@router.get("/raw/header")
+def raw_header(path: str, exif: bool = False):
     p = require_safe_path(path)
-    try:
-        with rawpy.imread(str(p)) as raw:
-            try:
-                thumb = raw.extract_thumb()
-                if thumb.format == rawpy.ThumbFormat.JPEG:
-                    im = Image.open(io.BytesIO(thumb.data))
-                    im = ImageOps.exif_transpose(im)
-                elif thumb.format == rawpy.ThumbFormat.BITMAP:
-                    im = Image.fromarray(thumb.data)
-                else:
-                    raise rawpy.LibRawUnsupportedThumbnailError("Unknown thumbnail format")
-            except (rawpy.LibRawNoThumbnailError, rawpy.LibRawUnsupportedThumbnailError):
-                rgb = raw.postprocess(
-                    output_bps=8,
-                    use_camera_wb=True,
-                    no_auto_bright=True,
-                    gamma=(1, 1),
-                    half_size=True,
-                    demosaic_algorithm=rawpy.DemosaicAlgorithm.AHD,
-                )
-                im = Image.fromarray(rgb)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to decode RAW: {str(e)}")
+    return JSONResponse(_raw_header(p, path, exif))
 
-    try:
-        if im.width == 0:
-            raise ValueError("Invalid image width")
-        im = resize_keep_ratio(im, w)
-        if im.mode != "RGB":
-            im = im.convert("RGB")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to resize/convert: {str(e)}")
 
-    buf = io.BytesIO()
-    im.save(buf, format="PNG")
-    buf.seek(0)
-    return Response(content=buf.getvalue(), media_type="image/png")
+@router.get("/raw/thumbnail")
+def raw_thumbnail(path: str, w: int = 512, decode: str = "auto", out: OutputFormat = Depends(output_format)):
+    """Embedded preview of the RAW; files without one are decoded (`decode` as for /raw/render)."""
+    p = require_safe_path(path)
+    _check_decode_mode(decode)
+
+    def render() -> Image.Image:
+        try:
+            with rawpy.imread(str(p)) as raw:
+                try:
+                    thumb = raw.extract_thumb()
+                    if thumb.format == rawpy.ThumbFormat.JPEG:
+                        im = open_near_width(io.BytesIO(thumb.data), w)
+                        im = ImageOps.exif_transpose(im)
+                    elif thumb.format == rawpy.ThumbFormat.BITMAP:
+                        im = Image.fromarray(thumb.data)
+                    else:
+                        raise rawpy.LibRawUnsupportedThumbnailError("Unknown thumbnail format")
+                except (rawpy.LibRawNoThumbnailError, rawpy.LibRawUnsupportedThumbnailError):
+                    # already rendered at width w: skips the resize below
+                    return render_thumbnail(preview_rgb(p, w, decode, raw)[0], w, stretch=None)
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Failed to decode RAW: {str(e)}")
+
+        try:
+            if im.width == 0:
+                raise ValueError("Invalid image width")
+            im = resize_keep_ratio(im, w)
+            if im.mode != "RGB":
+                im = im.convert("RGB")
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Failed to resize/convert: {str(e)}")
+
+        return im
+
+    return cached_render_response(p, "raw_thumbnail", render, out, w=w, decode=decode)
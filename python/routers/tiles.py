@@ -0,0 +1,35 @@
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import JSONResponse
+from PIL import Image
+
+from services.fits_service import FITS_EXTENSIONS
+from services.image_encode import OutputFormat, output_format
+from services.pyramid import pyramid_info, pyramid_state, render_tile
+from services.thumb_cache import cached_render_response
+from utils.path_guard import require_safe_path
+
+router = APIRouter()
+
+
+def _require_pyramid_source(path: str):
+    p = require_safe_path(path)
+    if p.suffix.lower() not in FITS_EXTENSIONS | {".xisf"}:
+        raise HTTPException(status_code=415, detail="Unsupported format (expecting FITS or XISF)")
+    return p
+
+
+@router.get("/image/tiles/info")
+def image_tiles_info(path: str):
+    p = _require_pyramid_source(path)
+    return JSONResponse(pyramid_info(pyramid_state(str(p))))
+
+
+@router.get("/image/tiles/{level}/{x}/{y}")
+def image_tile(level: int, x: int, y: int, path: str, out: OutputFormat = Depends(output_format)):
+    p = _require_pyramid_source(path)
+
+    def render() -> Image.Image:
+        im = render_tile(pyramid_state(str(p)), level, x, y)
+        return im
+
+    return cached_render_response(p, "tile", render, out, level=level, x=x, y=y)
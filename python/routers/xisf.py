@@ -1,11 +1,15 @@
-import io
+from typing import Optional
 
-from fastapi import APIRouter, HTTPException
-from fastapi.responses import JSONResponse, Response
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import JSONResponse
 from PIL import Image
 
-from services.xisf_service import _read_xisf_array, _read_xisf, _flatten_metadata
-from services.stretch import to_rgb_image, resize_keep_ratio
+from services.xisf_service import _read_xisf_array, _read_xisf, _flatten_metadata, xisf_working_set
+from services.image_encode import OutputFormat, output_format
+from services.memory_budget import MEMORY_BUDGET
+from services.stf import cached_channel_stats
+from services.stretch import render_thumbnail
+from services.thumb_cache import cached_render_response
 from utils.json_utils import _json_safe
 from utils.path_guard import require_safe_path
 
@@ -13,24 +17,29 @@ router = APIRouter()
 
 
 @router.get("/xisf/thumbnail")
-def xisf_thumbnail(path: str, w: int = 512):
+def xisf_thumbnail(path: str, w: int = 512, plane: Optional[int] = None,
+                   stretch: str = "asinh", linked: bool = True,
+                   out: OutputFormat = Depends(output_format)):
+    """
+    Colour (or mono) preview of the image; `plane` renders a single channel instead.
+    `stretch` is 'asinh' (percentile) or 'stf' (auto-STF, `linked` or per channel).
+    """
     p = require_safe_path(path)
     if not str(p).lower().endswith(".xisf"):
         raise HTTPException(status_code=415, detail="Unsupported format (expecting .xisf)")
 
-    arr = _read_xisf_array(str(p))
-    im = to_rgb_image(arr)
-    im = resize_keep_ratio(im, w)
+    def render() -> Image.Image:
+        with MEMORY_BUDGET.reserve(xisf_working_set(str(p), plane), "XISF decode"):
+            arr = _read_xisf_array(str(p), plane)
+            stats = cached_channel_stats(p, "xisf", lambda: arr, plane=plane) if stretch == "stf" else None
+            im = render_thumbnail(arr, w, stretch, linked=linked, stats=stats)
 
-    buf = io.BytesIO()
-    im.save(buf, format="PNG")
-    buf.seek(0)
-    return Response(content=buf.getvalue(), media_type="image/png")
+        return im
 
+    return cached_render_response(p, "xisf", render, out, w=w, plane=plane, stretch=stretch, linked=linked)
 
-@router.get("/xisf/header")
-def xisf_header(path: str):
-    p = require_safe_path(path)
+
+def _xisf_header(p, path: str) -> dict:
     if not str(p).lower().endswith(".xisf"):
         raise HTTPException(status_code=415, detail="Unsupported format (expecting .xisf)")
 
@@ -45,4 +54,10 @@ def xisf_header(path: str):
         "kind": "mono" if channels == 1 else "rgb_like",
         "metadata": _flatten_metadata(img_meta, file_meta),
     }
-    return JSONResponse(_json_safe(info))
+    return _json_safe(info)
+
+
+@router.get("/xisf/header")
+def xisf_header(path: str):
+    p = require_safe_path(path)
+    return JSONResponse(_xisf_header(p, path))
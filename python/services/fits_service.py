@@ -1,6 +1,26 @@
+import os
+
 import numpy as np
 from astropy.io import fits
 
+from services.memory_budget import array_working_set
+from services.precision import working_array
+from services.stretch import decimate
+
+# BITPIX → big-endian numpy dtype of the on-disk data block
+_BITPIX_DTYPES = {8: ">u1", 16: ">i2", 32: ">i4", 64: ">i8", -32: ">f4", -64: ">f8"}
+
+FITS_EXTENSIONS = {".fits", ".fit", ".fts", ".fz"}
+
+FITS_BLOCK = 2880
+CARD_LEN = 80
+_COMMENTARY_KEYS = {"COMMENT", "HISTORY", ""}
+
+# Target size of each converted row chunk streamed by /js9safe
+JS9_CHUNK_BYTES = 8 * 1024 * 1024
+# Full-resolution rows held at once while reducing a preview
+PREVIEW_BAND_BYTES = 8 * 1024 * 1024
+
 
 def first_image_hdu(hdul):
     """Return the first HDU that contains image data, or None."""
@@ -10,10 +30,432 @@ def first_image_hdu(hdul):
     return None
 
 
-def to_js9_safe_hdu(hdu):
+# ---------------------------------------------------------------------------
+# Header-only card scanner
+# ---------------------------------------------------------------------------
+
+def _parse_card_value(text: str):
+    """Parse the value field of a card (everything after '= ') → python value."""
+    text = text.lstrip()
+    if text.startswith("'"):
+        out, i = [], 1
+        while True:
+            j = text.find("'", i)
+            if j < 0:
+                raise ValueError("Unterminated string value")
+            out.append(text[i:j])
+            if text[j + 1:j + 2] == "'":
+                out.append("'")
+                i = j + 2
+                continue
+            return "".join(out).rstrip()
+
+    value = text.split("/", 1)[0].strip()
+    if value == "":
+        return None
+    if value == "T":
+        return True
+    if value == "F":
+        return False
+    if value.startswith("("):
+        re_s, im_s = value.strip("()").split(",")
+        return complex(float(re_s.replace("D", "E")), float(im_s.replace("D", "E")))
+    try:
+        return int(value)
+    except ValueError:
+        return float(value.replace("D", "E"))
+
+
+def _read_header_cards(f) -> list:
+    """Read 2880-byte blocks up to END and return [(key, value), ...]."""
+    cards = []
+    while True:
+        block = f.read(FITS_BLOCK)
+        if len(block) < FITS_BLOCK:
+            raise ValueError("Unexpected EOF in header")
+        text = block.decode("ascii")
+        for off in range(0, FITS_BLOCK, CARD_LEN):
+            card = text[off:off + CARD_LEN]
+            key = card[:8].rstrip()
+            if key == "END":
+                return cards
+            if key == "HIERARCH" and "=" in card:
+                name, rest = card[9:].split("=", 1)
+                cards.append((name.strip(), _parse_card_value(rest)))
+            elif key == "CONTINUE":
+                value = _parse_card_value(card[8:])
+                if not cards or not isinstance(cards[-1][1], str) or not cards[-1][1].endswith("&"):
+                    raise ValueError("Orphan CONTINUE card")
+                cards[-1] = (cards[-1][0], cards[-1][1][:-1] + value)
+            elif key not in _COMMENTARY_KEYS and card[8:10] == "= ":
+                cards.append((key, _parse_card_value(card[10:])))
+            else:
+                cards.append((key, card[8:].rstrip()))
+
+
+def _data_size(hdr: dict) -> int:
+    """Size in bytes of the data block following a header, padded to 2880."""
+    naxis = int(hdr.get("NAXIS", 0))
+    if naxis == 0:
+        return 0
+    n = 1
+    for k in range(1, naxis + 1):
+        n *= int(hdr[f"NAXIS{k}"])
+    size = abs(int(hdr["BITPIX"])) // 8 * int(hdr.get("GCOUNT", 1)) * (int(hdr.get("PCOUNT", 0)) + n)
+    return -(-size // FITS_BLOCK) * FITS_BLOCK
+
+
+def _has_image_data(hdr: dict) -> bool:
+    naxis = int(hdr.get("NAXIS", 0))
+    return naxis > 0 and all(int(hdr.get(f"NAXIS{k}", 0)) > 0 for k in range(1, naxis + 1))
+
+
+def scan_fits_header(path: str) -> list:
+    """
+    Return the cards of the first image HDU (or the primary HDU) without decoding any data.
+    Only header blocks are read; data blocks are skipped with a seek computed from
+    NAXISn/BITPIX/PCOUNT/GCOUNT. Raises ValueError on anything unusual (compressed
+    image HDUs, random groups, malformed cards) so callers can fall back to astropy.
+    """
+    with open(path, "rb", buffering=FITS_BLOCK * 8) as f:
+        primary = None
+        while True:
+            cards = _read_header_cards(f)
+            hdr = dict(cards)
+            if primary is None:
+                if cards[0][0] != "SIMPLE":
+                    raise ValueError("Not a FITS file")
+                if hdr.get("GROUPS"):
+                    raise ValueError("Random groups HDU")
+                primary = cards
+                is_image = True
+            else:
+                if hdr.get("ZIMAGE"):
+                    raise ValueError("Compressed image HDU")
+                is_image = hdr.get("XTENSION") == "IMAGE"
+            if is_image and _has_image_data(hdr):
+                return cards
+
+            f.seek(_data_size(hdr), 1)
+            if not f.peek(1):
+                return primary
+
+
+def read_fits_header(path: str) -> dict:
+    """
+    Header of the first image HDU (or the primary HDU) as a flat dict.
+    Uses the card scanner and falls back to astropy for files it can't handle.
+    """
+    try:
+        return dict(scan_fits_header(path))
+    except Exception:
+        with fits.open(path, memmap=False, ignore_missing_end=True) as hdul:
+            hdu = first_image_hdu(hdul) or hdul[0]
+            return dict(hdu.header.items())
+
+
+def fits_working_set(path: str) -> int:
+    """
+    Estimated bytes for the astropy fallback: the whole first image HDU decoded plus a
+    float32 working copy (see services.memory_budget). Reads headers only.
+    """
+    try:
+        hdr = dict(scan_fits_header(path))
+    except Exception:
+        with fits.open(path, ignore_missing_end=True) as hdul:
+            hdr = next((h.header for h in hdul if h.is_image and h.header.get("NAXIS", 0) > 0), hdul[0].header)
+    naxis = int(hdr.get("NAXIS", 0))
+    shape = [int(hdr.get(f"NAXIS{k}", 0)) for k in range(1, naxis + 1)]
+    return array_working_set(shape, abs(int(hdr.get("BITPIX", 8))) // 8) if naxis else 0
+
+
+def _plane_count(hdr) -> int:
+    """Number of 2D planes in an image HDU (product of NAXIS3..NAXISn)."""
+    n = 1
+    for k in range(3, int(hdr.get("NAXIS", 0)) + 1):
+        n *= int(hdr[f"NAXIS{k}"])
+    return n
+
+
+def _check_plane(hdr, plane: int):
+    n = _plane_count(hdr)
+    if not 0 <= plane < n:
+        raise ValueError(f"Plane {plane} out of range (image has {n} plane{'s' if n > 1 else ''})")
+
+
+def _map_plane(path: str, plane: int = 0):
+    """
+    Memory-map one plane of the first uncompressed image HDU.
+    Returns (header, memmap of shape (NAXIS2, NAXIS1) in on-disk dtype), or None
+    when the HDU can't be mapped directly (compressed, truncated, odd BITPIX, ...).
+    Only the requested plane's bytes are mapped; other planes of a cube are never read.
+    """
+    with fits.open(path, memmap=False, ignore_missing_end=True) as hdul:
+        for i, h in enumerate(hdul):
+            if not isinstance(h, (fits.PrimaryHDU, fits.ImageHDU)):
+                if isinstance(h, fits.CompImageHDU):
+                    return None
+                continue
+            hdr = h.header
+            naxis = hdr.get("NAXIS", 0)
+            if naxis >= 2 and all(hdr.get(f"NAXIS{k}", 0) > 0 for k in range(1, naxis + 1)):
+                offset = hdul.fileinfo(i)["datLoc"]
+                break
+        else:
+            return None
+
+    dtype = _BITPIX_DTYPES.get(hdr.get("BITPIX"))
+    if dtype is None:
+        return None
+    _check_plane(hdr, plane)
+    width, height = int(hdr["NAXIS1"]), int(hdr["NAXIS2"])
+    plane_bytes = width * height * np.dtype(dtype).itemsize
+    offset += plane * plane_bytes
+    if offset + plane_bytes > os.path.getsize(path):
+        return None
+    return hdr, np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(height, width))
+
+
+def _apply_scaling(data: np.ndarray, hdr) -> np.ndarray:
+    """Apply BSCALE/BZERO in place on a float array."""
+    bscale, bzero = float(hdr.get("BSCALE", 1.0)), float(hdr.get("BZERO", 0.0))
+    if bscale != 1.0:
+        data *= bscale
+    if bzero != 0.0:
+        data += bzero
+    return data
+
+
+def _blank_value(hdr):
+    """
+    BLANK of integer data as astropy applies it, or None where astropy ignores it:
+    float data, BLANK 0, and the unsigned-integer BZERO conventions (which stay integer).
+    """
+    blank, bitpix = hdr.get("BLANK"), int(hdr.get("BITPIX", 0))
+    if not blank or not isinstance(blank, int) or isinstance(blank, bool) or bitpix <= 0:
+        return None
+    bzero = float(hdr.get("BZERO", 0.0))
+    if float(hdr.get("BSCALE", 1.0)) == 1.0 and bzero == (-128 if bitpix == 8 else 1 << (bitpix - 1)):
+        return None
+    return blank
+
+
+def _physical_rows(raw: np.ndarray, hdr) -> np.ndarray:
+    """float32 physical values of raw on-disk data: BSCALE/BZERO applied, BLANK pixels NaN."""
+    data = _apply_scaling(np.asarray(raw, dtype=np.float32), hdr)
+    blank = _blank_value(hdr)
+    if blank is not None:
+        data[raw == blank] = np.nan
+    return data
+
+
+def _integer_physical(data: np.ndarray, hdr):
+    """
+    Physical values of 8/16-bit integer data as a native-endian integer array, or None
+    when BSCALE/BZERO need floats. The usual unsigned conventions (BITPIX 16 with
+    BZERO 32768, BITPIX 8 with BZERO -128) become a sign-bit flip instead of a float pass.
+    Keeping integers lets the stretch use its lookup-table path. Data with an effective
+    BLANK needs floats too (BLANK pixels become NaN).
+    """
+    if (data.dtype.kind not in "ui" or data.dtype.itemsize > 2 or float(hdr.get("BSCALE", 1.0)) != 1.0
+            or _blank_value(hdr) is not None):
+        return None
+    bzero = float(hdr.get("BZERO", 0.0))
+    out = data.astype(data.dtype.newbyteorder("="))
+    if bzero == 0.0:
+        return out
+    bits = 8 * out.dtype.itemsize
+    sign = 1 << (bits - 1)
+    if bzero == (sign if out.dtype.kind == "i" else -sign):
+        flipped = out.view(f"{'u' if out.dtype.kind == 'i' else 'i'}{out.dtype.itemsize}")
+        flipped ^= np.array(sign, dtype=np.uint64).astype(flipped.dtype)
+        return flipped
+    return None
+
+
+def bayer_pattern(hdr):
+    """
+    CFA pattern of an OSC frame as 4 letters for pixels (0,0) (0,1) (1,0) (1,1),
+    with XBAYROFF/YBAYROFF applied. None when BAYERPAT is absent or not an RGB pattern.
+    """
+    pat = str(hdr.get("BAYERPAT", "") or "").strip().upper()
+    if len(pat) != 4 or sorted(pat) != ["B", "G", "G", "R"]:
+        return None
+    xoff = int(hdr.get("XBAYROFF", 0) or 0) % 2
+    yoff = int(hdr.get("YBAYROFF", 0) or 0) % 2
+    return "".join(pat[((y + yoff) % 2) * 2 + (x + xoff) % 2] for y in (0, 1) for x in (0, 1))
+
+
+def superpixel_debayer(mosaic: np.ndarray, pattern: str) -> np.ndarray:
+    """
+    2×2 superpixel debayer: every CFA cell becomes one RGB pixel (R, mean of both G, B).
+    (H, W) mosaic → (H/2, W/2, 3) float32; a trailing odd row/column is dropped.
+    """
+    h2, w2 = mosaic.shape[0] // 2, mosaic.shape[1] // 2
+    out = np.zeros((h2, w2, 3), dtype=np.float32)
+    for i, color in enumerate(pattern):
+        dy, dx = divmod(i, 2)
+        cell = mosaic[dy:2 * h2:2, dx:2 * w2:2]
+        if color == "G":
+            out[..., 1] += cell
+        else:
+            out[..., "RGB".index(color)] = cell
+    out[..., 1] *= 0.5
+    return out
+
+
+def _reduce_preview(read_rows, shape, w: int, mode: str, pattern=None) -> np.ndarray:
+    """
+    Reduce a plane to at least `w` pixels wide, pulling rows through
+    read_rows(r0, r1, step) → float32 physical values.
+    mode 'stride' only asks for the rows it keeps; 'mean' walks the plane in bands of
+    ~PREVIEW_BAND_BYTES. With a CFA `pattern` every 2×2 cell is debayered first and
+    the result is an (h, w, 3) colour preview at a quarter of the pixel count.
+    """
+    height, width = shape
+    cell = 2 if pattern else 1
+    ch, cw = height // cell, width // cell
+    f = max(1, cw // max(1, w))
+
+    if mode == "stride":
+        cols = np.arange(0, cw, f) * cell
+        if not pattern:
+            return np.ascontiguousarray(read_rows(0, height, f)[:, cols])
+        even, odd = read_rows(0, 2 * ch, 2 * f), read_rows(1, 2 * ch, 2 * f)
+        mosaic = np.empty((2 * len(even), 2 * len(cols)), dtype=np.float32)
+        mosaic[0::2, 0::2], mosaic[0::2, 1::2] = even[:, cols], even[:, cols + 1]
+        mosaic[1::2, 0::2], mosaic[1::2, 1::2] = odd[:, cols], odd[:, cols + 1]
+        return superpixel_debayer(mosaic, pattern)
+
+    oh, ow = ch // f, cw // f
+    out = np.empty((oh, ow, 3) if pattern else (oh, ow), dtype=np.float32)
+    step = max(1, PREVIEW_BAND_BYTES // (width * 4 * cell * f))
+    for i0 in range(0, oh, step):
+        i1 = min(oh, i0 + step)
+        band = read_rows(i0 * f * cell, i1 * f * cell, 1)
+        if not pattern:
+            out[i0:i1] = decimate(band, f, "mean")
+            continue
+        rgb = superpixel_debayer(band, pattern)
+        for c in range(3):
+            out[i0:i1, :, c] = decimate(rgb[..., c], f, "mean")
+    return out
+
+
+def read_fits_preview(path: str, w: int, mode: str = "mean", debayer: bool = True, planes=0):
+    """
+    Read one image plane of a FITS file reduced to at least `w` pixels wide (float32).
+    Uncompressed data is memory-mapped from the plane's file offset and reduced in bands,
+    so peak memory follows the output size rather than the frame size. Tile-compressed
+    HDUs decode only the tile rows the reduction needs (see services.fits_tiles).
+    OSC frames carrying BAYERPAT come back as (h, w, 3) colour when `debayer` is set.
+    `planes` may also be a tuple of plane indices (e.g. (0, 1, 2) for an RGB cube),
+    stacked into an (h, w, len(planes)) array.
+    8/16-bit integer frames that need no averaging (stride mode, or already ≤ `w` wide)
+    come back in their integer physical dtype rather than float32.
+    Returns None when neither applies; callers then fall back to astropy.
+    """
+    if isinstance(planes, (tuple, list)):
+        chans = [read_fits_preview(path, w, mode, False, k) for k in planes]
+        return None if any(c is None for c in chans) else np.stack(chans, axis=2)
+
+    mapped = _map_plane(path, planes)
+    if mapped is not None:
+        hdr, mm = mapped
+        pattern = bayer_pattern(hdr) if debayer else None
+        try:
+            f = max(1, mm.shape[1] // max(1, w))
+            if not pattern and (mode == "stride" or f == 1):
+                ints = _integer_physical(mm[::f, ::f], hdr)
+                if ints is not None:
+                    return ints
+            return _reduce_preview(
+                lambda r0, r1, step: _physical_rows(mm[r0:r1:step], hdr),
+                mm.shape, w, mode, pattern,
+            )
+        finally:
+            del mm
+
+    from services.fits_tiles import open_compressed_plane
+
+    plane = open_compressed_plane(path, planes)
+    if plane is None:
+        return None
+    try:
+        pattern = bayer_pattern(plane.header) if debayer else None
+        return _reduce_preview(plane.read_rows, plane.shape, w, mode, pattern)
+    finally:
+        plane.close()
+
+
+def js9_safe_header(hdr, shape) -> bytes:
+    """Padded FITS header for a float32 PrimaryHDU of `shape`, without BZERO/BSCALE/BLANK."""
+    hdr = hdr.copy()
+    for k in ("BZERO", "BSCALE", "BLANK"):
+        if k in hdr:
+            del hdr[k]
+    # Zero-stride placeholder: lets astropy derive BITPIX/NAXISn without allocating the image
+    hdu = fits.PrimaryHDU(data=np.broadcast_to(np.float32(0), shape), header=hdr)
+    hdu.verify("silentfix")
+    return hdu.header.tostring().encode("ascii")
+
+
+def js9_safe_stream(path: str, plane: int = 0, chunk_bytes: int = JS9_CHUNK_BYTES):
+    """
+    Plan a streamed JS9-safe FITS (see `to_js9_safe_hdu`) for one image plane.
+    Rows are converted to big-endian float32 in chunks of ~`chunk_bytes`, straight from
+    the memory-mapped data block or from parallel-decoded compressed tiles, so no
+    full-size copy is ever held.
+    Returns (content_length, iterator of bytes), or None if the HDU can't be streamed.
+    """
+    mapped = _map_plane(path, plane)
+    if mapped is not None:
+        hdr, mm = mapped
+        shape = mm.shape
+
+        def read_rows(r0, r1):
+            return _physical_rows(mm[r0:r1], hdr)
+
+        def close():
+            pass
+    else:
+        from services.fits_tiles import open_compressed_plane
+
+        cp = open_compressed_plane(path, plane)
+        if cp is None:
+            return None
+        hdr, shape, read_rows, close = cp.header, cp.shape, cp.read_rows, cp.close
+
+    height, width = shape
+    try:
+        head = js9_safe_header(hdr, shape)
+    except Exception:
+        close()     # the generator below (which owns closing) never started
+        raise
+    nbytes = height * width * 4
+    pad = -nbytes % FITS_BLOCK
+    rows_per_chunk = max(1, chunk_bytes // (width * 4))
+    f32 = np.finfo(np.float32)
+
+    def body():
+        try:
+            yield head
+            for r0 in range(0, height, rows_per_chunk):
+                rows = read_rows(r0, min(height, r0 + rows_per_chunk))
+                np.nan_to_num(rows, copy=False, nan=0.0, posinf=f32.max, neginf=f32.min)
+                yield rows.astype(">f4", copy=False).tobytes()
+            if pad:
+                yield b"\0" * pad
+        finally:
+            close()
+
+    return len(head) + nbytes + pad, body()
+
+
+def to_js9_safe_hdu(hdu, plane: int = 0):
     """
     Convert an HDU to a JS9-safe float32 PrimaryHDU:
-    - take first plane of cubes
+    - take one plane of cubes (the first by default)
     - replace NaN/Inf
     - strip BZERO/BSCALE/BLANK to avoid re-scaling
     """
@@ -21,14 +463,16 @@ def to_js9_safe_hdu(hdu):
     if data is None:
         return hdu
     if data.ndim > 2:
-        data = data[0]
-    data = np.asarray(data, dtype=np.float64)
+        _check_plane(hdu.header, plane)
+        data = data.reshape(-1, *data.shape[-2:])[plane]
+    out = working_array(data, "float32")
     data = np.nan_to_num(
-        data,
+        out,
+        copy=np.may_share_memory(out, hdu.data),  # never modify the caller's HDU
         nan=0.0,
         posinf=np.finfo(np.float32).max,
         neginf=np.finfo(np.float32).min,
-    ).astype(np.float32)
+    )
 
     hdr = hdu.header.copy()
     for k in ("BZERO", "BSCALE", "BLANK"):
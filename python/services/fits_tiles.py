@@ -0,0 +1,150 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from astropy.io import fits
+
+from services.fits_service import _apply_scaling, _check_plane, _read_header_cards
+
+# Shared pool for tile decompression (imagecodecs releases the GIL while decoding)
+TILE_WORKERS = int(os.environ.get("FITS_TILE_WORKERS", os.cpu_count() or 1))
+_TILE_POOL = ThreadPoolExecutor(max_workers=TILE_WORKERS, thread_name_prefix="fits-tiles")
+
+# Rows decoded per pool job (consecutive tiles are grouped up to this many rows)
+TILE_JOB_ROWS = 64
+
+_RICE_DTYPES = {1: np.uint8, 2: np.int16, 4: np.int32}
+
+
+class CompressedPlane:
+    """
+    One plane of the first tile-compressed image HDU (.fz / CompImageHDU), decoded
+    tile-row by tile-row on demand. Tiles are decompressed in parallel on a shared pool.
+
+    Fast path: full-width RICE_1 integer tiles are read straight from the heap with
+    os.pread and decoded by imagecodecs. Anything else (GZIP, HCOMPRESS, quantized
+    floats, partial-width tiles, no imagecodecs) decodes tile bands via astropy's section.
+    Rows come back as float32 physical values (BSCALE/BZERO applied, BLANK as astropy does).
+    """
+
+    def __init__(self, path: str, hdul, index: int, plane: int = 0):
+        self.path = path
+        self.hdul = hdul
+        self.hdu = hdul[index]
+        self.header = self.hdu.header
+        _check_plane(self.header, plane)
+        self.height, self.width = int(self.header["NAXIS2"]), int(self.header["NAXIS1"])
+        self.shape = (self.height, self.width)
+        self.tile_rows = int(self.hdu.tile_shape[-2]) if len(self.hdu.tile_shape) >= 2 else 1
+        lead_shape = [int(self.header[f"NAXIS{k}"]) for k in range(int(self.header["NAXIS"]), 2, -1)]
+        self._lead = tuple(int(i) for i in np.unravel_index(plane, lead_shape)) if lead_shape else ()
+        # With ZTILE3..n = 1 (checked by the fast path) the tiles of plane k follow those of plane k-1
+        self._tile_base = plane * -(-self.height // self.tile_rows)
+        self._rice = self._rice_layout(hdul.fileinfo(index))
+
+    def _rice_layout(self, info):
+        """(heap offset, tile descriptors, dtype, blocksize) for the pread fast path, or None."""
+        try:
+            import imagecodecs  # noqa: F401
+        except ImportError:
+            return None
+        with open(self.path, "rb") as f:
+            f.seek(info["hdrLoc"])
+            bt = dict(_read_header_cards(f))
+        zvals = {bt.get(f"ZNAME{i}"): bt.get(f"ZVAL{i}") for i in range(1, 10) if f"ZNAME{i}" in bt}
+        bytepix = int(zvals.get("BYTEPIX", 4))
+        if (bt.get("ZCMPTYPE") != "RICE_1" or bt.get("TFIELDS") != 1
+                or bt.get("TTYPE1") != "COMPRESSED_DATA" or int(bt.get("ZBITPIX", -32)) < 0
+                or int(bt.get("ZTILE1", 0)) != self.width or bytepix not in _RICE_DTYPES
+                or any(int(bt.get(f"ZTILE{k}", 1)) != 1 for k in range(3, int(bt.get("ZNAXIS", 2)) + 1))):
+            return None
+
+        tform = str(bt.get("TFORM1", "")).lstrip("0123456789")
+        desc_dtype = {"P": ">i4", "Q": ">i8"}.get(tform[:1])
+        if desc_dtype is None:
+            return None
+        n_tiles = int(bt["NAXIS2"])
+        table_bytes = int(bt["NAXIS1"]) * n_tiles
+        with open(self.path, "rb") as f:
+            f.seek(info["datLoc"])
+            desc = np.frombuffer(f.read(table_bytes), dtype=desc_dtype).reshape(n_tiles, 2)
+        heap = info["datLoc"] + int(bt.get("THEAP", table_bytes))
+        return heap, desc, _RICE_DTYPES[bytepix], int(zvals.get("BLOCKSIZE", 32))
+
+    def _decode_tiles(self, t0: int, t1: int) -> np.ndarray:
+        """Physical values (float32) of the rows held by tiles t0..t1-1."""
+        r0 = t0 * self.tile_rows
+        r1 = min(t1 * self.tile_rows, self.height)
+        if self._rice is None:
+            return np.asarray(self.hdu.section[self._lead + (slice(r0, r1),)], dtype=np.float32)
+
+        import imagecodecs
+        heap, desc, dtype, blocksize = self._rice
+        # astropy applies BLANK to compressed integer data only along with BSCALE/BZERO
+        scaled = float(self.header.get("BSCALE", 1.0)) != 1.0 or float(self.header.get("BZERO", 0.0)) != 0.0
+        blank = self.header.get("BLANK") if scaled else None
+        out = np.empty((r1 - r0, self.width), dtype=np.float32)
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            for t in range(t0, t1):
+                a = t * self.tile_rows - r0
+                b = min(a + self.tile_rows, r1 - r0)
+                n, off = desc[t + self._tile_base]
+                buf = os.pread(fd, int(n), heap + int(off))
+                raw = imagecodecs.rcomp_decode(buf, shape=(b - a, self.width), dtype=dtype, nblock=blocksize)
+                out[a:b] = raw
+                if blank is not None:
+                    out[a:b][raw == blank] = np.nan
+        finally:
+            os.close(fd)
+        return _apply_scaling(out, self.header)
+
+    def read_rows(self, r0: int, r1: int, step: int = 1) -> np.ndarray:
+        """
+        Rows r0:r1:step as float32 physical values, decoding only the tiles that hold
+        them. Runs of consecutive tiles are split into jobs decoded in parallel.
+        """
+        rows = np.arange(r0, min(r1, self.height), step)
+        out = np.empty((len(rows), self.width), dtype=np.float32)
+        if not len(rows):
+            return out
+        tiles = np.unique(rows // self.tile_rows)
+        per_job = max(1, TILE_JOB_ROWS // self.tile_rows)
+
+        jobs, start = [], 0
+        for k in range(1, len(tiles) + 1):
+            if k == len(tiles) or tiles[k] != tiles[k - 1] + 1 or k - start == per_job:
+                jobs.append((int(tiles[start]), int(tiles[k - 1]) + 1))
+                start = k
+
+        def run(job):
+            t0, t1 = job
+            band = self._decode_tiles(t0, t1)
+            base = t0 * self.tile_rows
+            sel = (rows >= base) & (rows < base + len(band))
+            out[sel] = band[rows[sel] - base]
+
+        if self._rice is None:
+            # astropy's section decoder isn't safe to share across threads (and holds the GIL)
+            for job in jobs:
+                run(job)
+        else:
+            list(_TILE_POOL.map(run, jobs))
+        return out
+
+    def close(self):
+        self.hdul.close()
+
+
+def open_compressed_plane(path: str, plane: int = 0):
+    """Open one plane of the first tile-compressed image HDU, or return None if there is none."""
+    hdul = fits.open(path, memmap=True, ignore_missing_end=True)
+    try:
+        for i, h in enumerate(hdul):
+            if isinstance(h, fits.CompImageHDU) and h.header.get("NAXIS", 0) >= 2:
+                return CompressedPlane(path, hdul, i, plane)
+    except Exception:
+        hdul.close()
+        raise
+    hdul.close()
+    return None
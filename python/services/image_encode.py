@@ -0,0 +1,110 @@
+import io
+import os
+from typing import NamedTuple, Optional
+
+from fastapi import Header, HTTPException
+from PIL import Image
+
+# ---------------------------------------------------------------------------
+# Output encoding for rendered images
+#
+# Endpoints take `fmt=png|jpeg|webp` and `q=1..100`; without `fmt` the format is
+# negotiated from the Accept header (explicitly listed types beat wildcards at equal
+# q-value; q=0 means "not acceptable"), defaulting to PNG. The chosen format and quality are part of the
+# thumbnail cache key.
+# ---------------------------------------------------------------------------
+
+JPEG_QUALITY = int(os.environ.get("THUMB_JPEG_QUALITY", "85"))
+WEBP_QUALITY = int(os.environ.get("THUMB_WEBP_QUALITY", "80"))
+
+# name → (Pillow format, media type); PNG first: it wins ties and is the default
+_FORMATS = {
+    "png": ("PNG", "image/png"),
+    "webp": ("WEBP", "image/webp"),
+    "jpeg": ("JPEG", "image/jpeg"),
+}
+_ALIASES = {"jpg": "jpeg"}
+
+
+class OutputFormat(NamedTuple):
+    name: str                  # 'png' | 'jpeg' | 'webp'
+    quality: Optional[int]     # None for PNG (lossless)
+    negotiated: bool           # chosen from Accept → response must carry Vary: Accept
+
+    @property
+    def media_type(self) -> str:
+        return _FORMATS[self.name][1]
+
+
+def _parse_accept(accept: str) -> dict:
+    """media range → q-value, e.g. {'image/webp': 1.0, '*/*': 0.8}."""
+    out = {}
+    for part in accept.split(","):
+        fields = [f.strip() for f in part.split(";")]
+        if not fields[0]:
+            continue
+        q = 1.0
+        for f in fields[1:]:
+            if f.startswith("q="):
+                try:
+                    q = float(f[2:])
+                except ValueError:
+                    q = 0.0
+        out[fields[0].lower()] = q
+    return out
+
+
+def _negotiate(accept: Optional[str]) -> Optional[str]:
+    if not accept:
+        return None
+    ranges = _parse_accept(accept)
+    best, best_rank, refused = None, (0.0, 0), set()
+    for name, (_, media) in _FORMATS.items():
+        for rng, specificity in ((media, 2), ("image/*", 1), ("*/*", 0)):
+            if rng in ranges:
+                # the most specific matching range decides; q=0 rules the format out
+                if ranges[rng] <= 0:
+                    refused.add(name)
+                elif (ranges[rng], specificity) > best_rank:
+                    best, best_rank = name, (ranges[rng], specificity)
+                break
+    if best is None:
+        # nothing listed is on offer: fall back to the first format not refused
+        best = next((name for name in _FORMATS if name not in refused), None)
+    return best
+
+
+def output_format(fmt: Optional[str] = None, q: Optional[int] = None,
+                  accept: Optional[str] = Header(None)) -> OutputFormat:
+    """FastAPI dependency resolving `fmt`/`q`/Accept into an OutputFormat."""
+    negotiated = False
+    if fmt is not None:
+        name = _ALIASES.get(fmt.lower(), fmt.lower())
+        if name not in _FORMATS:
+            raise HTTPException(status_code=400, detail=f"Unsupported fmt '{fmt}' (expecting png, jpeg or webp)")
+    else:
+        name = _negotiate(accept)
+        negotiated = True
+        if name is None:
+            name = "png"
+    if q is not None and not 1 <= q <= 100:
+        raise HTTPException(status_code=400, detail="Quality 'q' must be between 1 and 100")
+    if name == "png":
+        quality = None
+    else:
+        quality = q if q is not None else (JPEG_QUALITY if name == "jpeg" else WEBP_QUALITY)
+    return OutputFormat(name, quality, negotiated)
+
+
+def encode_image(im: Image.Image, out: OutputFormat) -> bytes:
+    """Encode a PIL image as `out` (JPEG drops alpha/palette to RGB or L)."""
+    buf = io.BytesIO()
+    if out.name == "png":
+        im.save(buf, format="PNG")
+    elif out.name == "jpeg":
+        if im.mode not in ("RGB", "L"):
+            im = im.convert("RGB")
+        im.save(buf, format="JPEG", quality=out.quality)
+    else:
+        im.save(buf, format="WEBP", quality=out.quality)
+    return buf.getvalue()
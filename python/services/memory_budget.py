@@ -0,0 +1,112 @@
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from fastapi import HTTPException
+
+# ---------------------------------------------------------------------------
+# Service-wide memory budget for decodes
+#
+# Every full-frame decode (RAW demosaic, TIFF/XISF/PNG/JPEG reads, the astropy FITS
+# fallback) first reserves its estimated working set, computed from header
+# dimensions and dtype. Requests are admitted while the reserved total stays under
+# DECODE_MEMORY_BUDGET_BYTES; the rest wait in FIFO order (at most
+# DECODE_QUEUE_MAX of them, for at most DECODE_QUEUE_TIMEOUT_S). A full queue is
+# answered 429, a wait that times out 503, both with Retry-After.
+# Cache hits never reserve: only the render closures behind the caches do.
+# ---------------------------------------------------------------------------
+
+MEMORY_BUDGET_BYTES = int(os.environ.get("DECODE_MEMORY_BUDGET_BYTES", 1024 * 1024 * 1024))
+QUEUE_MAX = int(os.environ.get("DECODE_QUEUE_MAX", 32))
+QUEUE_TIMEOUT_S = float(os.environ.get("DECODE_QUEUE_TIMEOUT_S", 30))
+RETRY_AFTER_S = int(os.environ.get("DECODE_RETRY_AFTER_S", 5))
+
+
+class MemoryBudget:
+    """
+    Admission control over a byte budget (0 disables it). A single request larger
+    than the budget is admitted alone rather than never. Reservations nest: a
+    thread that already holds one is not charged again.
+    """
+
+    def __init__(self, budget: int, queue_max: int, queue_timeout: float, retry_after: int):
+        self.budget = budget
+        self.queue_max = queue_max
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self._cond = threading.Condition()
+        self._queue = deque()           # tickets of waiting requests, FIFO
+        self._in_use = 0
+        self._active = 0
+        self._local = threading.local()
+        self.stats = {"admitted": 0, "queued": 0, "rejected": 0, "timed_out": 0, "peak_bytes": 0}
+
+    @contextmanager
+    def reserve(self, nbytes: int, what: str = "decode"):
+        """Hold `nbytes` of the budget for the duration of the block (see class docstring)."""
+        if self.budget <= 0 or getattr(self._local, "held", False):
+            yield
+            return
+        n = min(max(int(nbytes), 0), self.budget)
+        with self._cond:
+            if self._queue or self._in_use + n > self.budget:
+                self._wait(n, what)
+            self._in_use += n
+            self._active += 1
+            self.stats["admitted"] += 1
+            self.stats["peak_bytes"] = max(self.stats["peak_bytes"], self._in_use)
+        self._local.held = True
+        try:
+            yield
+        finally:
+            self._local.held = False
+            with self._cond:
+                self._in_use -= n
+                self._active -= 1
+                self._cond.notify_all()
+
+    def _wait(self, n: int, what: str):
+        """Queue until this request is first in line and fits; called with the lock held."""
+        if len(self._queue) >= self.queue_max:
+            self.stats["rejected"] += 1
+            raise self._busy(429, f"Too many pending decodes; {what} rejected")
+        ticket = object()
+        self._queue.append(ticket)
+        self.stats["queued"] += 1
+        deadline = time.monotonic() + self.queue_timeout
+        try:
+            while self._queue[0] is not ticket or self._in_use + n > self.budget:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.stats["timed_out"] += 1
+                    raise self._busy(503, f"Memory budget exhausted; {what} timed out waiting")
+                self._cond.wait(remaining)
+        finally:
+            self._queue.remove(ticket)
+            self._cond.notify_all()
+
+    def _busy(self, status: int, detail: str) -> HTTPException:
+        return HTTPException(status_code=status, detail=detail, headers={"Retry-After": str(self.retry_after)})
+
+    def snapshot(self) -> dict:
+        with self._cond:
+            return {
+                **self.stats,
+                "queue_depth": len(self._queue),
+                "active": self._active,
+                "in_use_bytes": self._in_use,
+                "budget_bytes": self.budget,
+            }
+
+
+MEMORY_BUDGET = MemoryBudget(MEMORY_BUDGET_BYTES, QUEUE_MAX, QUEUE_TIMEOUT_S, RETRY_AFTER_S)
+
+
+def array_working_set(shape, itemsize: int, working_itemsize: int = 4) -> int:
+    """Bytes for a decoded array of `shape` plus one working copy (float32 by default)."""
+    n = 1
+    for d in shape:
+        n *= int(d)
+    return n * (itemsize + working_itemsize)
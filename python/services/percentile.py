@@ -0,0 +1,96 @@
+"""
+Percentile estimation for stretch black/white points.
+
+Modes:
+- 'exact'     np.percentile on the full array (one partition + copy per call).
+- 'histogram' exact for integer data: a bincount histogram (in bounded chunks) and a
+              cumulative-count lookup; gives the same values as np.percentile
+              (linear interpolation). Only used when the value range is ≤ HIST_MAX_RANGE.
+- 'sample'    np.percentile on a regular grid subsample of about PERCENTILE_SAMPLES pixels.
+              Error bound (DKW inequality, treating the grid as a random sample): the
+              rank of the returned value is within ε = sqrt(ln(2/δ) / (2n)) of the requested
+              one with probability 1-δ. With n = 262144, δ = 1e-3: ε ≈ 0.0038, i.e. asking for
+              the 99.9th percentile returns a value between the ~99.5th and the 100th.
+              Periodic patterns aligned with the grid step (e.g. Bayer mosaics) can bias it.
+- 'auto'      'histogram' for 8/16-bit integer data (whatever the size) and for larger integer
+              arrays with a narrow range, 'exact' for other small arrays, else 'sample'.
+NaN pixels are ignored (float data only; integers have none).
+"""
+import warnings
+
+import numpy as np
+
+PERCENTILE_SAMPLES = 1 << 18
+HIST_MAX_RANGE = 1 << 16
+_HIST_CHUNK = 1 << 20
+
+PERCENTILE_MODES = ("auto", "exact", "histogram", "sample")
+
+
+def _int_range(arr: np.ndarray):
+    """(lo, hi) value range for histogramming integer data, or None if too wide."""
+    if arr.dtype.kind not in "ui":
+        return None
+    if arr.dtype.itemsize <= 2 and arr.dtype.kind == "u":
+        return 0, int(np.iinfo(arr.dtype).max)
+    lo, hi = int(arr.min()), int(arr.max())
+    return (lo, hi) if hi - lo < HIST_MAX_RANGE else None
+
+
+def _histogram_percentiles(arr: np.ndarray, ps, lo: int, hi: int) -> list:
+    flat = arr.reshape(-1)
+    counts = np.zeros(hi - lo + 1, dtype=np.int64)
+    for i in range(0, flat.size, _HIST_CHUNK):
+        chunk = flat[i:i + _HIST_CHUNK]
+        if lo != 0:
+            chunk = chunk.astype(np.int64) - lo
+        counts += np.bincount(chunk, minlength=counts.size)
+    cum = np.cumsum(counts)
+    n = int(cum[-1])
+
+    out = []
+    for p in ps:
+        pos = p / 100.0 * (n - 1)
+        k0 = int(np.floor(pos))
+        k1 = min(k0 + 1, n - 1)
+        v0, v1 = np.searchsorted(cum, [k0, k1], side="right") + lo
+        out.append(float(v0 + (pos - k0) * (v1 - v0)))
+    return out
+
+
+def _grid_sample(arr: np.ndarray, n: int) -> np.ndarray:
+    if arr.ndim < 2:
+        step = max(1, arr.size // n)
+        return arr[::step]
+    step = max(1, int(np.ceil(np.sqrt(arr.shape[0] * arr.shape[1] / n))))
+    return arr[::step, ::step]
+
+
+def percentiles(arr: np.ndarray, ps, mode: str = "auto") -> list:
+    """Return the percentiles `ps` (0-100) of `arr` as floats, using `mode` (see module doc)."""
+    if mode not in PERCENTILE_MODES:
+        raise ValueError(f"Unknown percentile mode '{mode}'")
+    if mode == "auto":
+        if arr.dtype.kind in "ui" and arr.dtype.itemsize <= 2:
+            mode = "histogram"
+        elif arr.size <= PERCENTILE_SAMPLES:
+            mode = "exact"
+        elif _int_range(arr) is not None:
+            mode = "histogram"
+        else:
+            mode = "sample"
+
+    if mode == "histogram":
+        rng = _int_range(arr)
+        if rng is not None:
+            return _histogram_percentiles(arr, ps, *rng)
+        mode = "sample"
+    if mode == "sample":
+        arr = _grid_sample(arr, PERCENTILE_SAMPLES)
+    out = np.percentile(arr, ps)
+    if np.isnan(out).any():
+        # NaN (e.g. BLANK) pixels: percentiles of the valid ones; all-NaN stays NaN
+        with np.errstate(all="ignore"), warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            out = np.nanpercentile(arr, ps)
+    return [float(v) for v in out]
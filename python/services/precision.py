@@ -0,0 +1,34 @@
+import numpy as np
+
+# ---------------------------------------------------------------------------
+# Working precision for pixel data
+#
+# Renders and previews never need more than float32: 8/16-bit integer data stays in
+# its native dtype (the stretch runs it through a lookup table) and everything else
+# is converted to float32, halving memory and bandwidth against float64.
+# float64 is an explicit opt-in for analysis code that needs it.
+# ---------------------------------------------------------------------------
+
+PRECISIONS = ("native", "float32", "float64")
+DEFAULT_PRECISION = "native"
+
+
+def working_dtype(dtype, precision: str = DEFAULT_PRECISION) -> np.dtype:
+    """
+    dtype that data of `dtype` is worked on in:
+    'native'  → 8/16-bit integers unchanged (native byte order), anything else float32
+    'float32' → float32
+    'float64' → float64 (analysis opt-in)
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision '{precision}' (expecting one of {', '.join(PRECISIONS)})")
+    dtype = np.dtype(dtype)
+    if precision == "native" and dtype.kind in "ui" and dtype.itemsize <= 2:
+        return dtype.newbyteorder("=")
+    return np.dtype(np.float64 if precision == "float64" else np.float32)
+
+
+def working_array(arr, precision: str = DEFAULT_PRECISION) -> np.ndarray:
+    """`arr` as an ndarray in its working dtype (see `working_dtype`); no copy when it already is."""
+    arr = np.asarray(arr)
+    return np.asarray(arr, dtype=working_dtype(arr.dtype, precision))
@@ -0,0 +1,225 @@
+import math
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from astropy.io import fits
+from fastapi import HTTPException
+from PIL import Image
+
+from services.fits_service import _map_plane, _physical_rows, first_image_hdu, fits_working_set
+from services.memory_budget import MEMORY_BUDGET, array_working_set
+from services.percentile import percentiles
+from services.precision import working_array
+from services.stretch import decimate, stretch_rgb, stretch_with_limits
+from services.xisf_service import _map_xisf_image, _read_xisf_array, xisf_working_set
+
+# ---------------------------------------------------------------------------
+# Deep-zoom tile pyramid for large FITS / XISF masters
+#
+# Levels follow the Deep Zoom convention: level `max_level` is full resolution,
+# each level below halves both axes, level 0 is 1×1. Tiles are TILE_SIZE square
+# (smaller on the right/bottom edges), without overlap.
+#
+# Nothing is precomputed per level: a tile is rendered on first request, from the
+# source data (deep levels) or from a cached overview (shallow levels), and the
+# encoded tile goes to the thumbnail cache keyed on the file version.
+# Pyramid states are cached per file version, bounded by entry count and by bytes
+# (overview plus any source held in memory); concurrent first requests for a file
+# wait for one build instead of each decoding the master.
+# ---------------------------------------------------------------------------
+
+TILE_SIZE = 256
+OVERVIEW_MAX_SIZE = 2048       # longest side of the cached overview
+OVERVIEW_CACHE_ENTRIES = 8
+OVERVIEW_CACHE_BYTES = int(os.environ.get("PYRAMID_CACHE_BYTES", 512 * 1024 * 1024))
+_READ_CHUNK_BYTES = 32 * 1024 * 1024
+
+_OVERVIEWS = OrderedDict()     # file version → pyramid state
+_OVERVIEWS_BYTES = 0
+_OVERVIEWS_INFLIGHT = {}       # file version → lock held while that state is being built
+_OVERVIEWS_LOCK = threading.Lock()
+
+
+def _open_source(path: str):
+    """
+    Return (channels, height, width, read, resident) for the first image of a FITS/XISF
+    file, where read(r0, r1, c0, c1) → float32 (channels, rows, cols) physical values
+    and `resident` is the bytes `read` keeps in memory.
+    Uncompressed data is memory-mapped; compressed FITS decodes only the needed tiles,
+    from a plane opened per call (astropy's section decoder can't be shared across
+    threads); anything else is loaded once, under the memory budget, and sliced.
+    """
+    if path.lower().endswith(".xisf"):
+        mapped = _map_xisf_image(path)
+        if mapped is not None:
+            planes = mapped[0]
+        else:
+            with MEMORY_BUDGET.reserve(xisf_working_set(path), "XISF decode"):
+                arr = _read_xisf_array(path)
+            planes = np.moveaxis(arr, -1, 0) if arr.ndim == 3 else arr[None]
+        planes = planes[:3]
+        c, h, w = planes.shape
+        resident = 0 if mapped is not None else planes.nbytes
+        return c, h, w, lambda r0, r1, c0, c1: np.asarray(planes[:, r0:r1, c0:c1], dtype=np.float32), resident
+
+    mapped = _map_plane(path)
+    if mapped is not None:
+        hdr, mm = mapped
+        h, w = mm.shape
+        return 1, h, w, lambda r0, r1, c0, c1: _physical_rows(mm[r0:r1, c0:c1], hdr)[None], 0
+
+    from services.fits_tiles import open_compressed_plane
+
+    plane = open_compressed_plane(path)
+    if plane is not None:
+        h, w = plane.shape
+        plane.close()
+
+        def read(r0, r1, c0, c1):
+            cp = open_compressed_plane(path)
+            try:
+                return cp.read_rows(r0, r1)[None, :, c0:c1]
+            finally:
+                cp.close()
+
+        return 1, h, w, read, 0
+
+    with MEMORY_BUDGET.reserve(fits_working_set(path), "FITS decode"):
+        with fits.open(path, memmap=False, ignore_missing_end=True) as hdul:
+            hdu = first_image_hdu(hdul)
+            if hdu is None:
+                raise HTTPException(status_code=400, detail="No image data")
+            data = working_array(hdu.data, "float32")
+    resident = data.nbytes
+    while data.ndim > 2:
+        data = data[0]
+    h, w = data.shape
+    return 1, h, w, lambda r0, r1, c0, c1: data[None, r0:r1, c0:c1], resident
+
+
+def _block_mean(arr: np.ndarray, f: int, th: int, tw: int) -> np.ndarray:
+    """Reduce (C, h, w) by `f` to (C, th, tw), replicating edge pixels for partial blocks."""
+    c, h, w = arr.shape
+    ph, pw = max(0, th * f - h), max(0, tw * f - w)
+    if ph or pw:
+        arr = np.pad(arr, ((0, 0), (0, ph), (0, pw)), mode="edge")
+    arr = arr[:, :th * f, :tw * f]
+    if f == 1:
+        return arr
+    return arr.reshape(c, th, f, tw, f).mean(axis=(2, 4), dtype=np.float32)
+
+
+def _build_state(path: str) -> dict:
+    channels, height, width, read, resident = _open_source(path)
+    fo = 1 << max(0, math.ceil(math.log2(max(height, width) / OVERVIEW_MAX_SIZE)))
+
+    oh, ow = max(1, height // fo), max(1, width // fo)
+    band = fo * max(1, _READ_CHUNK_BYTES // (width * 4 * channels * fo))
+    need = channels * oh * ow * 4 + array_working_set((channels, band, width), 4)
+    with MEMORY_BUDGET.reserve(need, "pyramid overview"):
+        overview = np.empty((channels, oh, ow), dtype=np.float32)
+        for r0 in range(0, oh * fo, band):
+            r1 = min(oh * fo, r0 + band)
+            block = read(r0, r1, 0, ow * fo)
+            for c in range(channels):
+                overview[c, r0 // fo:r1 // fo] = decimate(block[c], fo, "mean")
+
+    max_level = max(0, math.ceil(math.log2(max(height, width))))
+    limits = [tuple(percentiles(overview[c], (0.1, 99.9))) for c in range(channels)]
+    return {
+        "width": width, "height": height, "channels": channels, "read": read,
+        "overview": overview, "overview_factor": fo, "max_level": max_level, "limits": limits,
+        "bytes": overview.nbytes + resident,
+    }
+
+
+def pyramid_state(path: str) -> dict:
+    """
+    Pyramid geometry, overview and stretch limits for the current version of `path`
+    (built once, even under concurrent calls).
+    """
+    st = os.stat(path)
+    key = (path, st.st_size, st.st_mtime_ns)
+    with _OVERVIEWS_LOCK:
+        state = _lookup_state(key)
+        if state is not None:
+            return state
+        pending = _OVERVIEWS_INFLIGHT.setdefault(key, threading.Lock())
+
+    with pending:
+        with _OVERVIEWS_LOCK:
+            state = _lookup_state(key)
+        if state is None:
+            try:
+                state = _build_state(path)
+                with _OVERVIEWS_LOCK:
+                    _put_state(key, state)
+            finally:
+                with _OVERVIEWS_LOCK:
+                    _OVERVIEWS_INFLIGHT.pop(key, None)
+    return state
+
+
+def _lookup_state(key):
+    state = _OVERVIEWS.get(key)
+    if state is not None:
+        _OVERVIEWS.move_to_end(key)
+    return state
+
+
+def _put_state(key, state: dict):
+    """Insert under _OVERVIEWS_LOCK; a state larger than the byte budget is not kept."""
+    global _OVERVIEWS_BYTES
+    if state["bytes"] > OVERVIEW_CACHE_BYTES:
+        return
+    _OVERVIEWS[key] = state
+    _OVERVIEWS_BYTES += state["bytes"]
+    while len(_OVERVIEWS) > OVERVIEW_CACHE_ENTRIES or _OVERVIEWS_BYTES > OVERVIEW_CACHE_BYTES:
+        _, evicted = _OVERVIEWS.popitem(last=False)
+        _OVERVIEWS_BYTES -= evicted["bytes"]
+
+
+def pyramid_info(state: dict) -> dict:
+    return {
+        "width": state["width"],
+        "height": state["height"],
+        "channels": min(state["channels"], 3),
+        "tile_size": TILE_SIZE,
+        "overlap": 0,
+        "min_level": 0,
+        "max_level": state["max_level"],
+    }
+
+
+def render_tile(state: dict, level: int, x: int, y: int) -> Image.Image:
+    """Render one tile with the file-wide stretch; 404 if outside the pyramid."""
+    if not 0 <= level <= state["max_level"]:
+        raise HTTPException(status_code=404, detail="Level out of range")
+    f = 1 << (state["max_level"] - level)
+    lw, lh = -(-state["width"] // f), -(-state["height"] // f)
+    if x < 0 or y < 0 or x * TILE_SIZE >= lw or y * TILE_SIZE >= lh:
+        raise HTTPException(status_code=404, detail="Tile out of range")
+    tw, th = min(TILE_SIZE, lw - x * TILE_SIZE), min(TILE_SIZE, lh - y * TILE_SIZE)
+
+    r0, c0 = y * TILE_SIZE * f, x * TILE_SIZE * f
+    fo = state["overview_factor"]
+    if f >= fo:
+        g = f // fo
+        ov = state["overview"]
+        region = ov[:, r0 // fo:(r0 // fo) + th * g, c0 // fo:(c0 // fo) + tw * g]
+        if region.shape[1] == 0 or region.shape[2] == 0:
+            region = ov[:, -1:, -1:]
+        data = _block_mean(region, g, th, tw)
+    else:
+        r1 = min(state["height"], r0 + th * f)
+        c1 = min(state["width"], c0 + tw * f)
+        with MEMORY_BUDGET.reserve(array_working_set((state["channels"], r1 - r0, c1 - c0), 4), "pyramid tile"):
+            data = _block_mean(state["read"](r0, r1, c0, c1), f, th, tw)
+
+    if len(data) >= 3:
+        limits = state["limits"]
+        return Image.fromarray(stretch_rgb([data[0], data[1], data[2]],
+                                           lambda c, ch, out: stretch_with_limits(ch, *limits[c], out=out)))
+    return Image.fromarray(stretch_with_limits(data[0], *state["limits"][0]), mode="L")
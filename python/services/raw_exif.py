@@ -0,0 +1,158 @@
+"""
+Bounded EXIF extraction for camera RAW files.
+
+exifread's `process_file` walks every IFD of the file (thumbnail, raw-data SubIFDs,
+...) one small seek + read at a time, which on a NAS means one round trip per tag.
+The header endpoints only need IFD0 and the EXIF IFD: `read_raw_exif` parses just
+those (exifread still decodes the tags, so values print exactly as before) through a
+`BlockReader`, which serves the many tiny reads from a few large aligned blocks.
+
+Containers: TIFF-based RAWs (NEF, CR2, ARW, DNG, ORF, RW2, PEF, SRW, …) directly,
+CR3 through its CMT1/CMT2 boxes (each a complete TIFF structure), RAF through the
+EXIF of the embedded JPEG preview. `full=True` falls back to exifread's complete
+walk (every IFD, no MakerNote), still block-buffered.
+
+The bounded parse drives exifread's ExifHeader directly (exifread.core, not public
+API), so requirements.txt pins exifread to the releases it is tested against.
+"""
+import os
+import struct
+from collections import OrderedDict
+
+from exifread import process_file
+from exifread.core.exif_header import ExifHeader
+from exifread.core.exceptions import ExifNotFound, InvalidExif
+from exifread.core.find_exif import determine_type, get_endian_str
+
+EXIF_BLOCK_BYTES = int(os.environ.get("RAW_EXIF_BLOCK_BYTES", 256 * 1024))
+EXIF_MAX_BLOCKS = 16    # blocks kept per file (IFD0, EXIF IFD and their value areas)
+
+# CR3 (ISO base media): moov/uuid box holding the Canon metadata boxes
+_CR3_BRAND = b"ftypcrx "
+_CR3_META_UUID = bytes.fromhex("85c0b687820f11e08111f4ce462b6a48")
+_CR3_IFDS = {b"CMT1": "Image", b"CMT2": "EXIF"}
+# RAF: big-endian offset of the embedded JPEG at byte 84
+_RAF_MAGIC = b"FUJIFILMCCD-RAW"
+_RAF_JPEG_OFFSET = 84
+
+
+class BlockReader:
+    """
+    Minimal read-only file object (read/seek/tell) over a file opened unbuffered.
+    Reads are served from EXIF_MAX_BLOCKS cached blocks of EXIF_BLOCK_BYTES; `base`
+    shifts position 0 into the file (e.g. to an embedded JPEG).
+    """
+
+    def __init__(self, f, block: int = EXIF_BLOCK_BYTES):
+        self._f = f
+        self.block = block
+        self.base = 0
+        self.size = os.fstat(f.fileno()).st_size
+        self._pos = 0
+        self._blocks = OrderedDict()   # block index → bytes
+        self.reads = 0
+        self.bytes_read = 0
+
+    def seek(self, pos: int, whence: int = 0) -> int:
+        if whence == 1:
+            pos += self._pos
+        elif whence == 2:
+            pos += self.size - self.base
+        self._pos = max(pos, 0)
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+    def read(self, n: int = -1) -> bytes:
+        at = self.base + self._pos
+        end = self.size if n is None or n < 0 else min(at + n, self.size)
+        parts = []
+        while at < end:
+            index, skip = divmod(at, self.block)
+            chunk = self._block(index)[skip:skip + end - at]
+            if not chunk:
+                break
+            parts.append(chunk)
+            at += len(chunk)
+        self._pos = at - self.base
+        return b"".join(parts)
+
+    def _block(self, index: int) -> bytes:
+        data = self._blocks.get(index)
+        if data is not None:
+            self._blocks.move_to_end(index)
+            return data
+        self._f.seek(index * self.block)
+        data = self._f.read(self.block)
+        self.reads += 1
+        self.bytes_read += len(data)
+        self._blocks[index] = data
+        if len(self._blocks) > EXIF_MAX_BLOCKS:
+            self._blocks.popitem(last=False)
+        return data
+
+
+def read_raw_exif(path, full: bool = False) -> dict:
+    """
+    EXIF tags of a RAW file as exifread returns them ('Image Model', 'EXIF FNumber', …
+    → IfdTag): IFD0 and the EXIF IFD only, or every IFD when `full`.
+    Unrecognised files give {}.
+    """
+    with open(path, "rb", buffering=0) as f:
+        fh = BlockReader(f)
+        head = fh.read(16)
+        if head[4:12] == _CR3_BRAND:
+            return _cr3_tags(fh)
+        if head.startswith(_RAF_MAGIC):
+            fh.seek(_RAF_JPEG_OFFSET)
+            fh.base = struct.unpack(">I", fh.read(4))[0]
+        fh.seek(0)
+        if full:
+            return process_file(fh, details=False, extract_thumbnail=False)
+        try:
+            offset, endian, fake_exif = determine_type(fh)
+        except (ExifNotFound, InvalidExif):
+            return {}
+        hdr = ExifHeader(fh, get_endian_str(endian)[0], offset, fake_exif, strict=False, detailed=False)
+        hdr.dump_ifd(hdr._first_ifd(), "Image")
+        exif = hdr.tags.get("Image ExifOffset")
+        if exif:
+            hdr.dump_ifd(exif.values[0], "EXIF")
+        return hdr.tags
+
+
+def _boxes(fh: BlockReader, start: int, end: int):
+    """(type, payload start, box end) of the ISO-BMFF boxes in [start, end)."""
+    at = start
+    while at + 8 <= end:
+        fh.seek(at)
+        size, kind = struct.unpack(">I4s", fh.read(8))
+        header = 8
+        if size == 1:
+            size, header = struct.unpack(">Q", fh.read(8))[0], 16
+        elif size == 0:
+            size = end - at
+        if size < header:
+            return
+        yield kind, at + header, at + size
+        at += size
+
+
+def _cr3_tags(fh: BlockReader) -> dict:
+    tags = {}
+    for kind, start, end in _boxes(fh, 0, fh.size):
+        if kind != b"moov":
+            continue
+        for kind, start, end in _boxes(fh, start, end):
+            fh.seek(start)
+            if kind != b"uuid" or fh.read(16) != _CR3_META_UUID:
+                continue
+            for kind, start, _ in _boxes(fh, start + 16, end):
+                if kind in _CR3_IFDS:
+                    fh.seek(start)
+                    hdr = ExifHeader(fh, get_endian_str(fh.read(2))[0], start, 0, strict=False, detailed=False)
+                    hdr.dump_ifd(hdr._first_ifd(), _CR3_IFDS[kind])
+                    tags.update(hdr.tags)
+        break
+    return tags
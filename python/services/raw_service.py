@@ -0,0 +1,319 @@
+import contextlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import rawpy
+
+from services.memory_budget import MEMORY_BUDGET
+from services.stretch import _run_channels
+
+# ---------------------------------------------------------------------------
+# Decoded-RAW cache
+#
+# LibRaw demosaicing dominates every RAW endpoint. Demosaiced arrays are kept in a
+# memory-bounded LRU keyed on the file version and the postprocess parameters, so
+# render, histogram and the thumbnail fallback share one decode per file. Concurrent
+# requests for the same key wait for the first decode instead of repeating it.
+# ---------------------------------------------------------------------------
+
+RAW_CACHE_BYTES = int(os.environ.get("RAW_DECODE_CACHE_BYTES", 256 * 1024 * 1024))
+
+# postprocess() parameters of the half-size preview decode used by the RAW endpoints
+RAW_PREVIEW_PARAMS = {
+    "output_bps": 8,
+    "use_camera_wb": True,
+    "no_auto_bright": True,
+    "gamma": (1, 1),
+    "half_size": True,
+    "demosaic_algorithm": rawpy.DemosaicAlgorithm.AHD,
+}
+
+
+class DecodedRawCache:
+    """LRU of read-only decoded arrays bounded by `budget` bytes (sum of array nbytes)."""
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # key → ndarray
+        self._bytes = 0
+        self._inflight = {}             # key → lock held while that key is being decoded
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get_or_decode(self, key, decode) -> np.ndarray:
+        """Cached array for `key`, or `decode()` it (once, even under concurrent calls)."""
+        with self._lock:
+            arr = self._lookup(key)
+            if arr is not None:
+                return arr
+            pending = self._inflight.setdefault(key, threading.Lock())
+
+        with pending:
+            with self._lock:
+                arr = self._lookup(key)
+            if arr is None:
+                try:
+                    arr = decode()
+                    arr.flags.writeable = False
+                    with self._lock:
+                        self.stats["misses"] += 1
+                        self._put(key, arr)
+                finally:
+                    with self._lock:
+                        self._inflight.pop(key, None)
+        return arr
+
+    def _lookup(self, key):
+        arr = self._entries.get(key)
+        if arr is not None:
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+        return arr
+
+    def _put(self, key, arr: np.ndarray):
+        if arr.nbytes > self.budget:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= old.nbytes
+        self._entries[key] = arr
+        self._bytes += arr.nbytes
+        while self._bytes > self.budget:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.nbytes
+            self.stats["evictions"] += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                **self.stats,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "budget_bytes": self.budget,
+                "decoding": len(self._inflight),
+            }
+
+
+RAW_CACHE = DecodedRawCache(RAW_CACHE_BYTES)
+
+# 'ahd': LibRaw postprocess (RAW_PREVIEW_PARAMS); 'superpixel': 2×2 binning of the
+# Bayer mosaic in NumPy; 'auto': superpixel when the requested width is at most
+# half the sensor width (what both modes deliver), else AHD.
+RAW_DECODE_MODES = ("auto", "ahd", "superpixel")
+
+
+def _file_version(path) -> tuple:
+    st = os.stat(path)
+    return str(path), st.st_size, st.st_mtime_ns
+
+
+def _open_raw(path, raw=None):
+    """Context manager yielding `raw` when the caller already has the file open, else a fresh handle."""
+    return contextlib.nullcontext(raw) if raw is not None else rawpy.imread(str(path))
+
+
+def decoded_raw(path, raw=None, **params) -> np.ndarray:
+    """
+    Demosaiced RGB array of a RAW file, `raw.postprocess(**params)` with
+    RAW_PREVIEW_PARAMS as defaults, shared through RAW_CACHE. The array is read-only.
+    `raw` is an already opened rawpy handle of `path` to decode from on a miss.
+    """
+    params = {**RAW_PREVIEW_PARAMS, **params}
+    key = _file_version(path) + (tuple(sorted(params.items())),)
+
+    def decode():
+        with _open_raw(path, raw) as raw_:
+            need = raw_working_set(raw_, params["half_size"], params["output_bps"])
+            with MEMORY_BUDGET.reserve(need, "RAW decode"):
+                return raw_.postprocess(**params)
+
+    return RAW_CACHE.get_or_decode(key, decode)
+
+
+def raw_working_set(raw, half_size: bool = True, output_bps: int = 8) -> int:
+    """
+    Estimated peak bytes of decoding `raw` (opened, not yet unpacked): the 16-bit
+    mosaic, LibRaw's 4×16-bit image buffer and the RGB output, at half size or full.
+    """
+    s = raw.sizes
+    pixels = (s.height // 2) * (s.width // 2) if half_size else s.height * s.width
+    return s.raw_height * s.raw_width * 2 + pixels * (8 + 3 * output_bps // 8)
+
+
+def superpixel_rgb(raw, output_bps: int = 8) -> np.ndarray:
+    """
+    Half-size RGB from the visible Bayer mosaic: every 2×2 CFA cell becomes one pixel
+    (R, mean of both G, B) after black level subtraction, scaling to the white level
+    and camera white balance (normalised so the smallest multiplier is 1, as LibRaw
+    does). Linear camera RGB, no colour matrix; `output_bps` 8 or 16.
+    Each channel is one lookup-table gather (G: over the sum of its two sites).
+    Raises ValueError for non-Bayer sensors (X-Trans, Foveon, linear DNG).
+    """
+    pattern = np.asarray(raw.raw_pattern)
+    desc = raw.color_desc.decode()
+    if pattern.shape != (2, 2) or sorted(desc[i] for i in pattern.flat) != ["B", "G", "G", "R"]:
+        raise ValueError("Not a 2x2 RGGB-family Bayer sensor")
+
+    mosaic = raw.raw_image_visible
+    h2, w2 = mosaic.shape[0] // 2, mosaic.shape[1] // 2
+    black = np.asarray(raw.black_level_per_channel, dtype=np.float64)
+    white = float(raw.white_level)
+    wb = np.asarray(raw.camera_whitebalance, dtype=np.float64)[:4].copy()
+    if wb[3] == 0:
+        wb[3] = wb[1]
+    if not (wb > 0).all():
+        wb[:] = 1.0
+    wb /= wb.min()
+
+    top = 255 if output_bps == 8 else 65535
+    out = np.empty((h2, w2, 3), dtype=np.uint8 if output_bps == 8 else np.uint16)
+
+    def bin_channel(c: int):
+        sites = [(i, j, int(pattern[i, j])) for i in range(2) for j in range(2) if desc[pattern[i, j]] == "RGB"[c]]
+        planes = [mosaic[i:2 * h2:2, j:2 * w2:2] for i, j, _ in sites]
+        offset = sum(black[ci] for _, _, ci in sites)
+        gain = np.mean([wb[ci] for _, _, ci in sites]) * top / max(white - offset / len(sites), 1.0) / len(sites)
+        index = planes[0] if len(planes) == 1 else np.add(planes[0], planes[1], dtype=np.uint32)
+        table = np.clip((np.arange(int(index.max()) + 1) - offset) * gain + 0.5, 0, top).astype(out.dtype)
+        out[..., c] = table[index]
+
+    _run_channels(bin_channel, 3)
+    return out
+
+
+def preview_rgb(path, w: int = None, mode: str = "auto", raw=None) -> tuple:
+    """
+    (rgb, mode used) for RAW previews, shared through RAW_CACHE. `mode` is one of
+    RAW_DECODE_MODES; 'auto' needs the target width `w` (None → superpixel).
+    Sensors the superpixel path can't handle fall back to AHD. `raw` is an already
+    opened rawpy handle of `path` to reuse instead of opening the file again.
+    """
+    if mode not in RAW_DECODE_MODES:
+        raise ValueError(f"Unknown decode mode '{mode}' (expecting one of {', '.join(RAW_DECODE_MODES)})")
+    if mode == "ahd":
+        return decoded_raw(path, raw), "ahd"
+
+    version = _file_version(path)
+
+    def decode(raw):
+        with MEMORY_BUDGET.reserve(raw_working_set(raw, True, RAW_PREVIEW_PARAMS["output_bps"]), "RAW decode"):
+            return superpixel_rgb(raw, RAW_PREVIEW_PARAMS["output_bps"])
+
+    with _open_raw(path, raw) as raw_:
+        if not (mode == "auto" and w is not None and w > raw_.sizes.width // 2):
+            try:
+                key = version + ("superpixel", RAW_PREVIEW_PARAMS["output_bps"])
+                return RAW_CACHE.get_or_decode(key, lambda: decode(raw_)), "superpixel"
+            except ValueError:
+                if mode == "superpixel":
+                    raise
+        return decoded_raw(path, raw_), "ahd"
+
+
+# ---------------------------------------------------------------------------
+# Bayer-level histograms and exposure statistics
+# ---------------------------------------------------------------------------
+
+HIST_BAND_ROWS = 256    # mosaic rows histogrammed per pass (bounds temporaries)
+
+
+def _bayer_sites(raw) -> list:
+    """[(row, col, colour index into 'RGB', CFA colour index)] for the 2×2 Bayer cell."""
+    pattern = np.asarray(raw.raw_pattern)
+    desc = raw.color_desc.decode()
+    if pattern.shape != (2, 2) or sorted(desc[i] for i in pattern.flat) != ["B", "G", "G", "R"]:
+        raise ValueError("Not a 2x2 RGGB-family Bayer sensor")
+    return [(i, j, "RGB".index(desc[pattern[i, j]]), int(pattern[i, j])) for i in range(2) for j in range(2)]
+
+
+def bayer_histograms(raw) -> np.ndarray:
+    """
+    Full-resolution (3, 65536) int64 counts of the visible mosaic's native values for
+    R, G (both sites) and B, every pixel counted (odd sizes included). Walks the
+    mosaic in bands of HIST_BAND_ROWS (even) rows, so only a band-sized piece of one
+    CFA site is ever copied.
+    """
+    sites = _bayer_sites(raw)
+    mosaic = raw.raw_image_visible
+    if mosaic.dtype != np.uint16:
+        raise ValueError(f"Unexpected mosaic dtype {mosaic.dtype}")
+    counts = np.zeros((3, 1 << 16), dtype=np.int64)
+    for r0 in range(0, mosaic.shape[0], HIST_BAND_ROWS):
+        band = mosaic[r0:r0 + HIST_BAND_ROWS]
+        for dy, dx, c, _ in sites:
+            counts[c] += np.bincount(band[dy::2, dx::2].ravel(), minlength=1 << 16)
+    return counts
+
+
+def bayer_levels(raw) -> tuple:
+    """(black level per colour R, G, B — averaged over its sites, white level)."""
+    black = np.asarray(raw.black_level_per_channel, dtype=np.float64)
+    per_colour = [[], [], []]
+    for _, _, c, ci in _bayer_sites(raw):
+        per_colour[c].append(black[ci])
+    return [float(np.mean(b)) for b in per_colour], int(raw.white_level)
+
+
+def cached_bayer_histograms(path) -> tuple:
+    """
+    (counts from `bayer_histograms`, black levels, white level), counts shared through
+    RAW_CACHE. Only this path fills the histogram entry; like every RAW_CACHE fill it
+    takes its MEMORY_BUDGET reservation inside the fill and is never started while the
+    caller holds one (a reservation held across a fill could wait on a key whose
+    filler waits on the budget).
+    """
+    def decode(raw):
+        with MEMORY_BUDGET.reserve(raw.sizes.raw_height * raw.sizes.raw_width * 2, "RAW histogram"):
+            return bayer_histograms(raw)
+
+    with rawpy.imread(str(path)) as raw:
+        levels = bayer_levels(raw)
+        counts = RAW_CACHE.get_or_decode(_file_version(path) + ("bayer_hist",), lambda: decode(raw))
+    return (counts,) + levels
+
+
+def _hist_median(values: np.ndarray, counts: np.ndarray) -> float:
+    """np.median of the sample described by (values, counts), values ascending."""
+    cum = np.cumsum(counts)
+    n = int(cum[-1])
+    if n == 0:
+        return 0.0
+    lo, hi = np.searchsorted(cum, [(n - 1) // 2, n // 2], side="right")
+    return (float(values[lo]) + float(values[hi])) / 2.0
+
+
+def histogram_stats(counts: np.ndarray, black: float, white: int) -> dict:
+    """Median, MAD (raw ADU) and the percentage of pixels at/below black or at/above white."""
+    values = np.arange(counts.size)
+    n = int(counts.sum())
+    if n == 0:
+        return {"median": None, "mad": None, "clipped_low_pct": None, "clipped_high_pct": None}
+    med = _hist_median(values, counts)
+    dist = np.abs(values - med)
+    order = np.argsort(dist, kind="stable")
+    mad = _hist_median(dist[order], counts[order])
+    return {
+        "median": med,
+        "mad": mad,
+        "clipped_low_pct": 100.0 * int(counts[:int(black) + 1].sum()) / n,
+        "clipped_high_pct": 100.0 * int(counts[white:].sum()) / n,
+    }
+
+
+def bin_histogram(counts: np.ndarray, top: int, bins: int, log: bool = False) -> tuple:
+    """
+    Re-bin full-resolution counts over [0, top] into `bins` bins with integer edges,
+    linear or logarithmic (first bin [0, 1), then geometric). Returns (edges, counts).
+    """
+    if log:
+        edges = np.concatenate([[0], np.geomspace(1, top + 1, bins)])
+    else:
+        edges = np.linspace(0, top + 1, bins + 1)
+    edges = np.round(edges).astype(np.int64)
+    edges[-1] = counts.size if top + 1 >= counts.size else top + 1
+    cum = np.concatenate([[0], np.cumsum(counts)])
+    binned = cum[edges[1:]] - cum[edges[:-1]]
+    binned[-1] += int(counts[edges[-1]:].sum())  # anything above the white level lands in the last bin
+    return edges, binned
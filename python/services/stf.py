@@ -0,0 +1,99 @@
+"""
+PixInsight-style automatic screen transfer function (auto-STF).
+
+Per channel, from the median and the normalised MAD (MADN = 1.4826·MAD) of the data
+rescaled to [0, 1] over its own range:
+    shadows   c0 = median + STF_SHADOWS_CLIP · MADN   (clamped to [0, 1])
+    midtones  m  = MTF(STF_TARGET_BACKGROUND, median - c0)
+    highlights   = 1
+so that the background median lands on STF_TARGET_BACKGROUND after the midtones
+transfer function MTF(m, x) = (m - 1)·x / ((2m - 1)·x - m).
+'Linked' averages the statistics over the colour channels (one curve for all three,
+keeps the colour balance); 'unlinked' fits each channel on its own (neutralises casts).
+
+Statistics are computed on a regular grid sample of the full-resolution data and cached
+per file version, so re-rendering at another width or switching linked/unlinked never
+re-scans the frame.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from services.percentile import PERCENTILE_SAMPLES, _grid_sample
+
+STF_TARGET_BACKGROUND = 0.25
+STF_SHADOWS_CLIP = -2.8
+MADN_FACTOR = 1.4826
+STATS_CACHE_ENTRIES = 256
+# Sources read at a requested width (FITS previews) sample their stats from a
+# stride-decimated read this wide: every kept pixel is an original, un-averaged one.
+STATS_SAMPLE_WIDTH = 1024
+
+_STATS = OrderedDict()     # (file version, kind, variant) → per-channel stats
+_STATS_LOCK = threading.Lock()
+
+
+def mtf(m: float, x):
+    """Midtones transfer function: maps 0 → 0, m → 0.5, 1 → 1."""
+    return (m - 1.0) * x / ((2.0 * m - 1.0) * x - m)
+
+
+def channel_stats(arr: np.ndarray) -> list:
+    """
+    (median, MADN, min, max) for each channel of an H×W or H×W×C array (first 3
+    channels), from a grid sample of about PERCENTILE_SAMPLES pixels. Non-finite
+    values are ignored.
+    """
+    sample = _grid_sample(arr, PERCENTILE_SAMPLES)
+    planes = [sample] if sample.ndim == 2 else [sample[..., c] for c in range(min(3, sample.shape[2]))]
+    out = []
+    for plane in planes:
+        v = np.asarray(plane, dtype=np.float32).reshape(-1)
+        v = v[np.isfinite(v)]
+        if v.size == 0:
+            out.append((0.0, 0.0, 0.0, 1.0))
+            continue
+        med = float(np.median(v))
+        madn = MADN_FACTOR * float(np.median(np.abs(v - med)))
+        out.append((med, madn, float(v.min()), float(v.max())))
+    return out
+
+
+def cached_channel_stats(path, kind: str, sample, **variant) -> list:
+    """
+    `channel_stats(sample())` for the current version of `path`, cached on
+    (path, size, mtime, kind, variant). `sample` is only called on a miss.
+    """
+    st = os.stat(path)
+    key = (str(path), st.st_size, st.st_mtime_ns, kind, tuple(sorted(variant.items())))
+    with _STATS_LOCK:
+        stats = _STATS.get(key)
+        if stats is not None:
+            _STATS.move_to_end(key)
+            return stats
+
+    stats = channel_stats(sample())
+    with _STATS_LOCK:
+        _STATS[key] = stats
+        while len(_STATS) > STATS_CACHE_ENTRIES:
+            _STATS.popitem(last=False)
+    return stats
+
+
+def stf_params(stats: list, linked: bool = True) -> list:
+    """Per-channel (shadows, highlights, midtones) in data units from `channel_stats` output."""
+    if linked and len(stats) > 1:
+        med, madn = np.mean([s[0] for s in stats]), np.mean([s[1] for s in stats])
+        lo, hi = min(s[2] for s in stats), max(s[3] for s in stats)
+        stats = [(med, madn, lo, hi)] * len(stats)
+
+    out = []
+    for med, madn, lo, hi in stats:
+        span = hi - lo if hi > lo else 1.0
+        med_n = (med - lo) / span
+        c0 = min(max(med_n + STF_SHADOWS_CLIP * madn / span, 0.0), 1.0) if madn > 0 else 0.0
+        m = mtf(STF_TARGET_BACKGROUND, med_n - c0) if med_n > c0 else 0.5
+        out.append((lo + c0 * span, lo + span, float(m)))
+    return out
@@ -1,39 +1,141 @@
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Optional
+
 import numpy as np
-from PIL import Image
+from PIL import ExifTags, Image
 
+from services.percentile import percentiles
+from services.stf import channel_stats, stf_params
 
-def _percentile_asinh_8bit(arr: np.ndarray, p_low=0.1, p_high=99.9, asinh_soft=10.0) -> np.ndarray:
-    """Stretch a float array to 8-bit using percentile clipping + asinh compression."""
-    arr = arr.astype(np.float32)
-    lo = np.percentile(arr, p_low)
-    hi = np.percentile(arr, p_high)
-    if hi <= lo:
-        hi = lo + 1.0
-    arr = np.clip((arr - lo) / (hi - lo), 0.0, 1.0)
-    arr = np.arcsinh(asinh_soft * arr) / np.arcsinh(asinh_soft)
-    return np.clip(arr * 255.0 + 0.5, 0, 255).astype(np.uint8)
+# Integer data up to this many bits is stretched through a uint8 lookup table:
+# one gather per pixel, no float temporaries. Tables are cached per stretch configuration.
+LUT_MAX_BITS = 16
+LUT_CACHE_ENTRIES = 32
+# Pixels gathered per np.take call: bounds its intp copy of the indices
+_LUT_BAND_PIXELS = 1 << 19
+
+# Colour renders stretch (and reduce) their channels concurrently; NumPy releases the
+# GIL in these kernels.
+CHANNEL_WORKERS = int(os.environ.get("STRETCH_CHANNEL_WORKERS", min(3, os.cpu_count() or 1)))
+_CHANNEL_POOL = ThreadPoolExecutor(max_workers=max(1, CHANNEL_WORKERS), thread_name_prefix="stretch")
+
+
+def _percentile_asinh_8bit(arr: np.ndarray, p_low=0.1, p_high=99.9, asinh_soft=10.0,
+                           pmode: str = "auto") -> np.ndarray:
+    """Stretch an array to 8-bit using percentile clipping + asinh compression."""
+    lo, hi = percentiles(arr, (p_low, p_high), pmode)
+    return stretch_with_limits(arr, lo, hi, "asinh", asinh_soft)
 
 
-def stretch_channel(arr: np.ndarray, stretch: str, bp_pct: float, wp_pct: float) -> np.ndarray:
-    """Apply custom stretch to a float array → uint8.
+def stretch_channel(arr: np.ndarray, stretch: str, bp_pct: float, wp_pct: float,
+                    pmode: str = "auto", out: Optional[np.ndarray] = None) -> np.ndarray:
+    """Apply custom stretch to an array → uint8 (integer data uses the LUT path).
     stretch: 'linear' | 'sqrt' | 'log' | 'asinh'
     bp_pct/wp_pct: percentile clipping (e.g. 0.1 / 99.9)
+    pmode: percentile estimation mode (see services.percentile)
+    out: optional uint8 array (e.g. one channel of an RGB buffer) to write into
+    """
+    lo, hi = percentiles(arr, (bp_pct, wp_pct), pmode)
+    return stretch_with_limits(arr, lo, hi, stretch, out=out)
+
+
+def stretch_with_limits(arr: np.ndarray, lo: float, hi: float, stretch: str = "asinh",
+                        soft: float = 10.0, out: Optional[np.ndarray] = None) -> np.ndarray:
+    """Map [lo, hi] → [0, 1], apply the stretch curve and quantize to uint8.
+    Used directly when black/white points are fixed across calls (e.g. pyramid tiles).
+    `soft` is the asinh softness, or the midtones balance m (0..1) for 'mtf'.
+    8/16-bit integer input goes through a lookup table (see `_stretch_lut`).
+    """
+    if _use_lut(arr):
+        table = _stretch_lut(arr.dtype.newbyteorder("="), float(lo), float(hi), stretch, float(soft))
+        if out is None:
+            out = np.empty(arr.shape, dtype=np.uint8)
+        # Unsigned view: signed values index the two's-complement layout directly
+        idx = arr.view(np.dtype(f"u{arr.dtype.itemsize}").newbyteorder(arr.dtype.byteorder))
+        rows = max(1, _LUT_BAND_PIXELS // max(1, arr[0].size)) if arr.ndim > 1 else arr.size or 1
+        for r0 in range(0, len(idx), rows):
+            np.take(table, idx[r0:r0 + rows], out=out[r0:r0 + rows], mode="wrap")
+        return out
+    return _stretch_float(arr, lo, hi, stretch, soft, out)
+
+
+def _use_lut(arr: np.ndarray) -> bool:
+    if arr.dtype.kind not in "ui" or arr.dtype.itemsize * 8 > LUT_MAX_BITS:
+        return False
+    # Building a 16-bit table costs about as much as stretching 64k pixels directly
+    return arr.dtype.itemsize == 1 or arr.size >= (1 << 16)
+
+
+@lru_cache(maxsize=LUT_CACHE_ENTRIES)
+def _stretch_lut(dtype: np.dtype, lo: float, hi: float, stretch: str, soft: float) -> np.ndarray:
     """
-    arr = arr.astype(np.float32)
-    lo = np.percentile(arr, bp_pct)
-    hi = np.percentile(arr, wp_pct)
+    uint8 table with one entry per value of an 8/16-bit integer dtype. Signed tables are
+    laid out in two's-complement order, so negative values index from the end and
+    `table[arr]` works for both signed and unsigned arrays.
+    """
+    values = np.arange(1 << (8 * dtype.itemsize), dtype=f"u{dtype.itemsize}").view(dtype)
+    table = _stretch_float(values, lo, hi, stretch, soft)
+    table.flags.writeable = False
+    return table
+
+
+def _stretch_float(arr: np.ndarray, lo: float, hi: float, stretch: str, soft: float,
+                   out: Optional[np.ndarray] = None) -> np.ndarray:
+    x = arr.astype(np.float32)  # private working copy, transformed in place below
     if hi <= lo:
         hi = lo + 1.0
-    arr = np.clip((arr - lo) / (hi - lo), 0.0, 1.0)
+    x -= lo
+    x /= hi - lo
+    np.clip(x, 0.0, 1.0, out=x)
     if stretch == 'log':
-        arr = np.log1p(arr * 9.0) / np.log1p(9.0)
+        x *= 9.0
+        np.log1p(x, out=x)
+        x /= np.log1p(9.0)
     elif stretch == 'sqrt':
-        arr = np.sqrt(arr)
+        np.sqrt(x, out=x)
     elif stretch == 'asinh':
-        soft = 10.0
-        arr = np.arcsinh(soft * arr) / np.arcsinh(soft)
+        x *= soft
+        np.arcsinh(x, out=x)
+        x /= np.arcsinh(soft)
+    elif stretch == 'mtf':
+        den = (2.0 * soft - 1.0) * x - soft
+        x *= soft - 1.0
+        x /= den
     # else: linear (no transform)
-    return np.clip(arr * 255.0 + 0.5, 0, 255).astype(np.uint8)
+    x *= 255.0
+    x += 0.5
+    np.clip(x, 0, 255, out=x)
+    if out is None:
+        return x.astype(np.uint8)
+    out[...] = x
+    return out
+
+
+def _run_channels(fn, n: int):
+    """Call fn(0) … fn(n-1), concurrently on the shared channel pool when n > 1."""
+    if n > 1 and CHANNEL_WORKERS > 1:
+        list(_CHANNEL_POOL.map(fn, range(n)))
+    else:
+        for c in range(n):
+            fn(c)
+
+
+def stretch_rgb(channels: list, stretch_one) -> np.ndarray:
+    """
+    Stretch up to 3 channels into one preallocated H×W×3 uint8 buffer, ready for
+    Image.fromarray. `stretch_one(c, channel, out)` writes channel c into `out`
+    (an H×W view of the buffer); channels run concurrently on the shared pool.
+    Missing channels repeat the first.
+    """
+    out = np.empty(channels[0].shape[:2] + (3,), dtype=np.uint8)
+    n = min(3, len(channels))
+    _run_channels(lambda c: stretch_one(c, channels[c], out[..., c]), n)
+    for c in range(n, 3):
+        out[..., c] = out[..., 0]
+    return out
 
 
 def to_rgb_image(arr: np.ndarray) -> Image.Image:
@@ -42,15 +144,118 @@ def to_rgb_image(arr: np.ndarray) -> Image.Image:
         ch = _percentile_asinh_8bit(arr)
         return Image.fromarray(ch, mode="L").convert("RGB")
     if arr.ndim == 3:
-        chs = [_percentile_asinh_8bit(arr[..., c]) for c in range(min(arr.shape[2], 3))]
-        while len(chs) < 3:
-            chs.append(chs[0])
-        return Image.merge("RGB", [Image.fromarray(c) for c in chs])
+        rgb = stretch_rgb([arr[..., c] for c in range(min(arr.shape[2], 3))],
+                          lambda c, ch, out: stretch_channel(ch, "asinh", 0.1, 99.9, out=out))
+        return Image.fromarray(rgb)
     # Fallback
     return Image.fromarray(_percentile_asinh_8bit(arr), mode="L").convert("RGB")
 
 
+def reduce_to_width(arr: np.ndarray, w: int) -> np.ndarray:
+    """
+    Block-average an H×W or H×W×C array by the largest integer factor that keeps it
+    at least `w` pixels wide. Returned as-is (dtype included) when there is nothing to reduce.
+    """
+    f = arr.shape[1] // max(1, w)
+    if f <= 1:
+        return arr
+    if arr.ndim == 2:
+        return decimate(arr, f)
+    out = np.empty((arr.shape[0] // f, arr.shape[1] // f, arr.shape[2]), dtype=np.float32)
+    _run_channels(lambda c: decimate(arr[..., c], f, out=out[..., c]), arr.shape[2])
+    return out
+
+
+def render_thumbnail(arr: np.ndarray, w: int, stretch: Optional[str] = "asinh", bp_pct: float = 0.1,
+                     wp_pct: float = 99.9, pmode: str = "auto", linked: bool = True,
+                     stats: Optional[list] = None) -> Image.Image:
+    """
+    Thumbnail pipeline: block-average toward `w` (reduce_to_width), stretch each channel
+    at that size, then a final LANCZOS pass to exactly `w`. Percentiles and the stretch
+    run on roughly w² pixels instead of the full frame.
+    stretch='stf' applies the auto screen transfer function (services.stf), linked or not,
+    from `stats` (per-channel `channel_stats`, normally cached per file) or, failing
+    that, from the reduced array itself.
+    2D input gives an "L" image, H×W×C an RGB one (first 3 channels, a single channel
+    repeated). stretch=None skips the stretch for data that is already 8-bit display values.
+    """
+    small = reduce_to_width(arr, w)
+    if small.ndim == 3 and small.shape[2] == 1:
+        small = small[..., 0]
+    channels = [small] if small.ndim == 2 else [small[..., c] for c in range(min(3, small.shape[2]))]
+    if stretch is None:
+        out = small if small.dtype == np.uint8 else np.clip(small + 0.5, 0, 255).astype(np.uint8)
+    else:
+        if stretch == "stf":
+            params = stf_params(stats if stats is not None else channel_stats(small), linked)
+
+            def stretch_one(c, ch, o=None):
+                lo, hi, m = params[c]
+                return stretch_with_limits(ch, lo, hi, "mtf", m, out=o)
+        else:
+            def stretch_one(c, ch, o=None):
+                return stretch_channel(ch, stretch, bp_pct, wp_pct, pmode, out=o)
+        out = stretch_one(0, small) if small.ndim == 2 else stretch_rgb(channels, stretch_one)
+    # Output height follows the original aspect ratio, not the block-trimmed one
+    h = max(1, int(arr.shape[0] * (w / arr.shape[1])))
+    return Image.fromarray(out).resize((w, h), Image.LANCZOS)
+
+
+def decimate(arr, factor: int, mode: str = "mean", out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Reduce a 2D array (ndarray or memmap) by an integer factor → float32.
+    mode: 'mean' (block average, processed in bands of `factor` rows so only one
+    band is materialised at a time) | 'stride' (keep every factor-th pixel).
+    Trailing rows/columns that don't fill a whole block are dropped.
+    `out`, if given, is a float32 (rows // factor, cols // factor) array written in place.
+    """
+    f = max(1, int(factor))
+    if out is not None and (f == 1 or mode == "stride"):
+        out[...] = arr[::f, ::f][:out.shape[0], :out.shape[1]]
+        return out
+    if f == 1:
+        return np.asarray(arr, dtype=np.float32)
+    if mode == "stride":
+        return np.asarray(arr[::f, ::f], dtype=np.float32)
+
+    oh, ow = arr.shape[0] // f, arr.shape[1] // f
+    if out is None:
+        out = np.empty((oh, ow), dtype=np.float32)
+    for i in range(oh):
+        band = np.asarray(arr[i * f:(i + 1) * f, :ow * f])
+        out[i] = band.reshape(f, ow, f).mean(axis=(0, 2), dtype=np.float32)
+    return out
+
+
+# Cheap decode-time reductions (JPEG DCT scaling, box reduce) stop at this multiple of
+# the target width and leave the rest to LANCZOS, as Pillow's thumbnail() does.
+REDUCING_GAP = 2.0
+
+
 def resize_keep_ratio(im: Image.Image, w: int) -> Image.Image:
     """Resize PIL Image to width w, preserving aspect ratio."""
     h = max(1, int(im.height * (w / im.width)))
     return im.resize((w, h), Image.LANCZOS)
+
+
+def open_near_width(fp, w: int) -> Image.Image:
+    """
+    Open an image decoded at the smallest size the format gives cheaply that is still
+    at least REDUCING_GAP × `w` wide (displayed, i.e. after EXIF orientation): JPEG
+    through draft() (DCT scaling by 1/2, 1/4 or 1/8 while decoding), other formats
+    through reduce() by the integer factor. `resize_keep_ratio` then only resamples
+    the remainder.
+    """
+    im = Image.open(fp)
+    if w <= 0:
+        return im
+    rotated = im.getexif().get(ExifTags.Base.Orientation, 1) in (5, 6, 7, 8)
+    scale = REDUCING_GAP * w / (im.height if rotated else im.width)
+    tw, th = math.ceil(im.width * scale), math.ceil(im.height * scale)
+    if im.format == "JPEG":
+        im.draft(None, (tw, th))
+    else:
+        factor = min(im.width // tw, im.height // th)
+        if factor >= 2 and im.mode not in ("1", "P"):
+            im = im.reduce(factor)
+    return im
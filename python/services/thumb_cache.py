@@ -0,0 +1,181 @@
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+from fastapi.responses import Response
+
+from services.image_encode import OutputFormat, encode_image
+
+# ---------------------------------------------------------------------------
+# Two-tier (memory LRU + disk) cache for rendered thumbnails
+# ---------------------------------------------------------------------------
+
+MEM_BUDGET_BYTES = int(os.environ.get("THUMB_CACHE_MEM_BYTES", 64 * 1024 * 1024))
+DISK_BUDGET_BYTES = int(os.environ.get("THUMB_CACHE_DISK_BYTES", 1024 * 1024 * 1024))
+DISK_DIR = os.environ.get("THUMB_CACHE_DIR", os.path.join(tempfile.gettempdir(), "astropsy-thumbs"))
+
+# Part of every cache key: bump when stretch, resampling or encoding output changes, so
+# renders left in the disk tier by a previous deploy are no longer served
+RENDER_VERSION = 1
+
+
+class ThumbnailCache:
+    """
+    Rendered-bytes cache keyed on the source file version and render parameters.
+    Memory tier: LRU bounded by `mem_budget` bytes.
+    Disk tier: one file per entry under `disk_dir`, bounded by `disk_budget` bytes,
+    evicted least-recently-used first. Set a budget to 0 to disable that tier.
+    """
+
+    def __init__(self, mem_budget: int, disk_budget: int, disk_dir: str):
+        self.mem_budget = mem_budget
+        self.disk_budget = disk_budget
+        self.disk_dir = Path(disk_dir)
+        self._lock = threading.Lock()
+        self._mem = OrderedDict()    # key → bytes
+        self._mem_bytes = 0
+        self._disk = OrderedDict()   # key → size on disk
+        self._disk_bytes = 0
+        self.stats = {"mem_hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+        if self.disk_budget > 0:
+            self._load_disk_index()
+
+    def _load_disk_index(self):
+        try:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+            entries = sorted(
+                (e for e in os.scandir(self.disk_dir) if e.is_file() and not e.name.startswith(".")),
+                key=lambda e: e.stat().st_mtime,
+            )
+        except OSError:
+            self.disk_budget = 0
+            return
+        for e in entries:
+            size = e.stat().st_size
+            self._disk[e.name] = size
+            self._disk_bytes += size
+        self._evict_disk()
+
+    def get(self, key: str):
+        with self._lock:
+            data = self._mem.get(key)
+            if data is not None:
+                self._mem.move_to_end(key)
+                self.stats["mem_hits"] += 1
+                return data
+            on_disk = key in self._disk
+
+        if on_disk:
+            try:
+                data = (self.disk_dir / key).read_bytes()
+                os.utime(self.disk_dir / key)
+            except OSError:
+                data = None
+            with self._lock:
+                if data is None:
+                    self._disk_bytes -= self._disk.pop(key, 0)
+                else:
+                    self._disk.move_to_end(key)
+                    self.stats["disk_hits"] += 1
+                    self._put_mem(key, data)
+                    return data
+
+        with self._lock:
+            self.stats["misses"] += 1
+        return None
+
+    def put(self, key: str, data: bytes):
+        with self._lock:
+            self._put_mem(key, data)
+        if 0 < len(data) <= self.disk_budget:
+            self._put_disk(key, data)
+
+    def _put_mem(self, key: str, data: bytes):
+        if len(data) > self.mem_budget:
+            return
+        old = self._mem.pop(key, None)
+        if old is not None:
+            self._mem_bytes -= len(old)
+        self._mem[key] = data
+        self._mem_bytes += len(data)
+        while self._mem_bytes > self.mem_budget:
+            _, evicted = self._mem.popitem(last=False)
+            self._mem_bytes -= len(evicted)
+            self.stats["evictions"] += 1
+
+    def _put_disk(self, key: str, data: bytes):
+        try:
+            fd, tmp = tempfile.mkstemp(dir=self.disk_dir, prefix=".tmp-")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, self.disk_dir / key)
+        except OSError:
+            return
+        with self._lock:
+            self._disk_bytes -= self._disk.pop(key, 0)
+            self._disk[key] = len(data)
+            self._disk_bytes += len(data)
+            self._evict_disk()
+
+    def _evict_disk(self):
+        while self._disk_bytes > self.disk_budget and self._disk:
+            name, size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            self.stats["evictions"] += 1
+            try:
+                os.unlink(self.disk_dir / name)
+            except OSError:
+                pass
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                **self.stats,
+                "mem_entries": len(self._mem),
+                "mem_bytes": self._mem_bytes,
+                "mem_budget_bytes": self.mem_budget,
+                "disk_entries": len(self._disk),
+                "disk_bytes": self._disk_bytes,
+                "disk_budget_bytes": self.disk_budget,
+            }
+
+
+THUMB_CACHE = ThumbnailCache(MEM_BUDGET_BYTES, DISK_BUDGET_BYTES, DISK_DIR)
+
+
+def thumb_cache_key(p: Path, kind: str, **params) -> str:
+    """Key on RENDER_VERSION, the resolved path, file size and mtime, endpoint kind and render params."""
+    st = os.stat(p)
+    parts = [f"v{RENDER_VERSION}", str(p), str(st.st_size), str(st.st_mtime_ns), kind]
+    parts += [f"{k}={params[k]}" for k in sorted(params)]
+    return hashlib.sha256("\0".join(parts).encode()).hexdigest()
+
+
+def cached_image_response(p: Path, kind: str, render, media_type: str = "image/png", **params) -> Response:
+    """
+    Return the cached rendering for (file version, kind, params), or call `render()`
+    (→ encoded bytes), store and return it. Failures raised by `render` are not cached.
+    """
+    key = thumb_cache_key(p, kind, media_type=media_type, **params)
+    data = THUMB_CACHE.get(key)
+    status = "hit"
+    if data is None:
+        data = render()
+        THUMB_CACHE.put(key, data)
+        status = "miss"
+    return Response(content=data, media_type=media_type, headers={"X-Thumb-Cache": status})
+
+
+def cached_render_response(p: Path, kind: str, render, out: OutputFormat, **params) -> Response:
+    """
+    `cached_image_response` for a `render()` returning a PIL image, encoded as `out`
+    (see services.image_encode). Format and quality are part of the cache key.
+    """
+    resp = cached_image_response(p, kind, lambda: encode_image(render(), out), out.media_type,
+                                 q=out.quality, **params)
+    if out.negotiated:
+        resp.headers["Vary"] = "Accept"
+    return resp
@@ -1,40 +1,210 @@
+import contextlib
+from typing import Optional
+
 import numpy as np
 import tifffile as tiff
 from PIL import Image
 from fastapi import HTTPException
 
-from services.stretch import to_rgb_image
+from services.memory_budget import MEMORY_BUDGET, array_working_set
+from services.precision import working_array
+from services.stf import cached_channel_stats
+from services.stretch import render_thumbnail, resize_keep_ratio, to_rgb_image
+
 
+def _is_tiff_prefix(prefix: bytes) -> bool:
+    """Return True if `prefix` (the first bytes of a file) is TIFF or BigTIFF magic."""
+    return prefix[:4] in (b"II*\x00", b"MM\x00*", b"II+\x00", b"MM\x00+")
 
-def _sniff_tiff_magic(path: str) -> bool:
-    """Return True if the file starts with TIFF or BigTIFF magic bytes."""
+
+def tiff_working_set(tf, plan=None) -> int:
+    """
+    Estimated bytes to decode the first image of the open TiffFile `tf` (the reduced
+    read `plan` from `_preview_plan`, else the first page) and stretch it (see
+    services.memory_budget).
+    """
     try:
-        with open(path, "rb") as f:
-            magic = f.read(4)
-        return magic in (b"II*\x00", b"MM\x00*", b"II+\x00", b"MM\x00+")
+        if plan is None:
+            page = tf.pages[0]
+            return array_working_set(page.shape, page.dtype.itemsize)
+        kind, src, f = plan
+        if kind == "level":
+            return array_working_set(src.shape, src.dtype.itemsize)
+        sep, _, h, width, contig = src.shaped
+        return array_working_set((-(-h // f), -(-width // f), sep * contig), src.dtype.itemsize)
     except Exception:
-        return False
+        return 0
+
+
+# ---------------------------------------------------------------------------
+# Reduced reads for thumbnails
+#
+# A TIFF with reduced-resolution levels (SubIFDs, or reduced pages of a pyramid, as
+# tifffile lists them in series.levels) is read from the smallest level at least `w`
+# wide. Otherwise, frames at least twice as wide as `w` are stride-sampled one
+# segment (tile or strip) at a time: only the segments that contain a sampled row
+# and column are read and decoded, so once the stride exceeds the tile size most
+# tiles are never touched.
+# ---------------------------------------------------------------------------
+
+_PREVIEW_AXES = ("YX", "YXS", "SYX")
+# Photometric interpretations whose samples are display values as stored; palette,
+# CMYK, MinIsWhite, YCbCr etc. are left to the Pillow path, which converts them.
+_PREVIEW_PHOTOMETRIC = (tiff.PHOTOMETRIC.MINISBLACK, tiff.PHOTOMETRIC.RGB)
+
+
+def _preview_plan(tf, w: int):
+    """("level", series level, 1) | ("strided", page, stride) | None for the first series of `tf`."""
+    series = tf.series[0]
+    if series.keyframe.photometric not in _PREVIEW_PHOTOMETRIC:
+        return None
+    levels = [lv for lv in series.levels if lv.axes in _PREVIEW_AXES]
+    if not levels or levels[0] is not series.levels[0]:
+        return None
+    width = lambda lv: lv.shape[lv.axes.index("X")]
+    level = min((lv for lv in levels if width(lv) >= w), key=width, default=levels[0])
+    if level is not levels[0]:
+        return "level", level, 1
+    f = width(level) // w
+    if f < 2 or len(level.pages) != 1 or level.keyframe.shaped[1] != 1:
+        return None
+    return "strided", level.keyframe, f
+
+
+def _strided_read(tf, page, f: int) -> np.ndarray:
+    """page[::f, ::f] as (h, w, samples), decoding only the segments that hold sampled pixels."""
+    sep, _, height, width, contig = page.shaped
+    seg_h, seg_w = (page.tilelength, page.tilewidth) if page.is_tiled else (page.rowsperstrip, width)
+    seg_h, seg_w = min(seg_h, height), min(seg_w, width)
+    ny, nx = -(-height // seg_h), -(-width // seg_w)
+    out = np.zeros((-(-height // f), -(-width // f), sep * contig), dtype=page.dtype)
+    fh = tf.filehandle
+
+    def sampled(seg: int, size: int, total: int):
+        """(first sampled index inside segment `seg`, its output index, count)."""
+        first = -(-seg * size // f) * f
+        end = min((seg + 1) * size, total)
+        return (first - seg * size, first // f, len(range(first, end, f))) if first < end else None
 
+    for ty in range(ny):
+        rows = sampled(ty, seg_h, height)
+        if rows is None:
+            continue
+        r_in, r_out, nr = rows
+        for tx in range(nx):
+            cols = sampled(tx, seg_w, width)
+            if cols is None:
+                continue
+            c_in, c_out, nc = cols
+            for s in range(sep):
+                index = (s * ny + ty) * nx + tx
+                if not page.databytecounts[index]:
+                    continue
+                fh.seek(page.dataoffsets[index])
+                seg, _, _ = page.decode(fh.read(page.databytecounts[index]), index, jpegtables=page.jpegtables)
+                out[r_out:r_out + nr, c_out:c_out + nc, s * contig:(s + 1) * contig] = \
+                    seg[0, r_in::f, c_in::f][:nr, :nc]
+    return out
 
-def open_tiff_as_image(path: str) -> Image.Image:
+
+def read_tiff_preview(tf, plan):
+    """
+    The reduced read `plan` (from `_preview_plan`) of the open TiffFile `tf`, as H×W or
+    H×W×3, from a pyramid level or stride-sampled segment by segment (see above).
+    Returns (array, source) with `source` naming the read ('level<i>' or 'strided<f>').
+    """
+    kind, src, f = plan
+    if kind == "level":
+        arr = src.asarray()
+        if src.axes == "SYX":
+            arr = np.moveaxis(arr, 0, -1)
+        source = f"level{tf.series[0].levels.index(src)}"
+    else:
+        arr = _strided_read(tf, src, f)
+        source = f"strided{f}"
+    if arr.ndim == 3:
+        arr = arr[..., :3] if arr.shape[2] >= 3 else arr[..., 0]
+    return arr, source
+
+
+def _display_samples(page, arr: np.ndarray) -> np.ndarray:
+    """Samples of `page` (None: unknown) with MinIsWhite inverted so that larger means brighter."""
+    if page is None or page.photometric != tiff.PHOTOMETRIC.MINISWHITE:
+        return arr
+    if arr.dtype.kind == "u":
+        return ((1 << page.bitspersample) - 1 - arr).astype(arr.dtype)
+    return -arr.astype(np.float32)
+
+
+def open_tiff_as_image(path: str, w: Optional[int] = None, stretch: str = "asinh",
+                       linked: bool = True) -> Image.Image:
     """
     Open a TIFF file as an RGB 8-bit PIL Image.
     Tries Pillow first, falls back to tifffile for BigTIFF / float32 / compressed formats.
+    With `w`, the result is a `w`-wide thumbnail read from a reduced level or a stride
+    sample when the file allows (`read_tiff_preview`), and high-bit-depth data is reduced
+    before it is stretched (see services.stretch.render_thumbnail) with `stretch`
+    ('asinh' percentile, or 'stf' auto-STF from statistics cached per file version).
+    The decode runs under a MEMORY_BUDGET reservation sized from the file's own layout,
+    parsed once: the same TiffFile serves the estimate, the reduced read and the
+    tifffile fallback.
     """
+    try:
+        tf = tiff.TiffFile(path)
+    except Exception as e:
+        tf, e_open = None, e        # not parseable by tifffile: Pillow may still read it
+    with tf if tf is not None else contextlib.nullcontext():
+        plan = None
+        if tf is not None and w is not None:
+            try:
+                plan = _preview_plan(tf, w)
+            except Exception:
+                plan = None
+        with MEMORY_BUDGET.reserve(tiff_working_set(tf, plan) if tf is not None else 0, "TIFF decode"):
+            return _decode_tiff(path, tf, plan, w, stretch, linked,
+                                e_open if tf is None else None)
+
+
+def _decode_tiff(path: str, tf, plan, w: Optional[int], stretch: str, linked: bool,
+                 e_open: Optional[Exception]) -> Image.Image:
+    """`open_tiff_as_image` once `tf` (None if tifffile couldn't open it, see `e_open`) and `plan` are known."""
+    def stretched(arr: np.ndarray, source: str) -> Image.Image:
+        """`source` names the read `arr` came from: stats of one read never serve another."""
+        arr = working_array(arr)
+        if w is None:
+            return to_rgb_image(arr)
+        stats = cached_channel_stats(path, "tif", lambda: arr, source=source) if stretch == "stf" else None
+        return render_thumbnail(arr, w, stretch, linked=linked, stats=stats).convert("RGB")
+
+    if plan is not None:
+        try:
+            preview = read_tiff_preview(tf, plan)
+        except Exception:
+            preview = None
+        if preview is not None:
+            arr, source = preview
+            if arr.dtype == np.uint8:
+                return resize_keep_ratio(Image.fromarray(arr), w).convert("RGB")
+            return stretched(arr, source)
+
+    page = tf.pages[0] if tf is not None else None
     try:
         im = Image.open(path)
         if getattr(im, "n_frames", 1) > 1:
             im.seek(0)
         if im.mode in ("I;16", "I;16B", "I;16L", "I;16S", "I", "F", "I;32F"):
-            return to_rgb_image(np.array(im))
+            # Pillow converts MinIsWhite only at 1 and 8 bits
+            return stretched(_display_samples(page, np.array(im)), "pillow")
+        if w is not None:
+            im = resize_keep_ratio(im, w)
         if im.mode != "RGB":
             im = im.convert("RGB")
         return im
     except Exception as e_pillow:
         try:
-            with tiff.TiffFile(path) as tf:
-                arr = tf.pages[0].asarray()
-                return to_rgb_image(arr)
+            if tf is None:
+                raise e_open
+            return stretched(_display_samples(page, page.asarray()), "page")
         except Exception as e_tiff:
             raise HTTPException(
                 status_code=415,
@@ -1,12 +1,20 @@
+from typing import Optional
+
 import numpy as np
 from fastapi import HTTPException
 
+from services.memory_budget import array_working_set
+from services.precision import DEFAULT_PRECISION, working_array
 from utils.json_utils import _json_safe, _to_float
 
 
-def _read_xisf_array(path: str) -> np.ndarray:
+def _read_xisf_array(path: str, plane: Optional[int] = None,
+                     precision: str = DEFAULT_PRECISION) -> np.ndarray:
     """
-    Read an XISF file into a float64 numpy array (H×W mono or H×W×3 RGB).
+    Read an XISF file into a numpy array (H×W mono or H×W×3 RGB) in the working dtype
+    for `precision` (services.precision: native 8/16-bit integers or float32 by default,
+    float64 on request). With `plane`, return only that channel as H×W. Uncompressed planar images
+    read just the selected channels; anything else falls back to a full read.
     Lazily imports the xisf package.
     """
     try:
@@ -17,6 +25,16 @@ def _read_xisf_array(path: str) -> np.ndarray:
             detail="XISF support not installed. pip install xisf",
         ) from e
 
+    mapped = _map_xisf_image(path)
+    if mapped is not None:
+        mm, _ = mapped
+        chc = mm.shape[0]
+        if plane is not None:
+            _check_channel(plane, chc)
+            return working_array(mm[plane], precision)
+        n = 3 if chc >= 3 else 1
+        return np.moveaxis(working_array(mm[:n], precision), 0, -1)
+
     try:
         data = XISF.read(path)
     except Exception as e:
@@ -25,10 +43,60 @@ def _read_xisf_array(path: str) -> np.ndarray:
     arr = np.asarray(data)
     if arr.ndim > 3:
         arr = arr[0]
+    if plane is not None:
+        chc = arr.shape[2] if arr.ndim == 3 else 1
+        _check_channel(plane, chc)
+        return working_array(arr[..., plane] if arr.ndim == 3 else arr, precision)
     if arr.ndim == 3 and arr.shape[2] not in (1, 3):
         arr = arr[..., :3] if arr.shape[2] >= 3 else arr[..., :1]
 
-    return arr.astype(np.float64, copy=False)
+    return working_array(arr, precision)
+
+
+def xisf_working_set(path: str, plane: Optional[int] = None) -> int:
+    """Estimated bytes for `_read_xisf_array` plus a float32 working copy (see services.memory_budget)."""
+    try:
+        from xisf import XISF
+        meta = XISF(path).get_images_metadata()[0]
+        w, h, chc = meta["geometry"]
+        itemsize = np.dtype(meta["dtype"]).itemsize
+    except Exception:
+        return 0
+    if not meta.get("compression"):
+        chc = 1 if plane is not None else min(chc, 3)   # mapped read of the selected channels
+    return array_working_set((h, w, chc), itemsize)
+
+
+def _check_channel(plane: int, channels: int):
+    if not 0 <= plane < channels:
+        raise HTTPException(status_code=400,
+                            detail=f"Plane {plane} out of range (image has {channels} channel{'s' if channels > 1 else ''})")
+
+
+def _map_xisf_image(path: str):
+    """
+    Memory-map the first image of an XISF file as a (channels, H, W) planar array.
+    Returns (memmap, image metadata), or None when the data block is compressed,
+    inline/embedded or not planar (callers then fall back to a full read).
+    """
+    try:
+        from xisf import XISF
+    except ImportError:
+        return None
+
+    try:
+        meta = XISF(path).get_images_metadata()[0]
+        w, h, chc = meta["geometry"]
+    except Exception:
+        return None
+    location = meta.get("location") or ()
+    if (meta.get("compression") or location[:1] != ("attachment",)
+            or meta.get("pixelStorage", "Planar") != "Planar"):
+        return None
+    dtype = np.dtype(meta["dtype"])
+    if location[2] < chc * h * w * dtype.itemsize:
+        return None
+    return np.memmap(path, dtype=dtype, mode="r", offset=location[1], shape=(chc, h, w)), meta
 
 
 def _read_xisf(path: str):
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Service modules import as top-level packages (services.*, routers.*), as under app.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,113 @@
+import io
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from services.fits_service import first_image_hdu, js9_safe_stream, read_fits_preview, to_js9_safe_hdu
+
+
+def _astropy_js9(path, plane=0) -> bytes:
+    with fits.open(path, memmap=False, ignore_missing_end=True) as hdul:
+        buf = io.BytesIO()
+        fits.HDUList([to_js9_safe_hdu(first_image_hdu(hdul), plane)]).writeto(
+            buf, overwrite=True, output_verify="silentfix")
+        return buf.getvalue()
+
+
+def _streamed_js9(path, plane=0) -> bytes:
+    plan = js9_safe_stream(path, plane, chunk_bytes=64)
+    assert plan is not None
+    length, body = plan
+    data = b"".join(body)
+    assert len(data) == length
+    return data
+
+
+def _write_raw(path, raw, cards, compressed=False):
+    """Write `raw` as the on-disk integers of an image HDU carrying `cards` (no rescaling)."""
+    if compressed:
+        hdu = fits.CompImageHDU(raw, compression_type="RICE_1")
+    else:
+        hdu = fits.PrimaryHDU(raw)
+    for k, v in cards.items():
+        hdu.header[k] = v
+    hdu._do_not_scale_image_data = True
+    hdu._bzero, hdu._bscale = 0, 1
+    hdul = fits.HDUList([fits.PrimaryHDU(), hdu] if compressed else [hdu])
+    hdul.writeto(path, overwrite=True)
+    with fits.open(path, do_not_scale_image_data=True) as check:
+        np.testing.assert_array_equal(check[-1].data, raw)
+
+
+def _raw_frame(dtype=np.int16, shape=(2, 37, 29)):
+    rng = np.random.default_rng(5)
+    info = np.iinfo(dtype)
+    raw = rng.integers(info.min, info.max, size=shape, endpoint=True).astype(dtype)
+    raw.flat[::11] = info.min
+    raw.flat[::17] = 7
+    return raw
+
+
+@pytest.mark.parametrize("cards", [
+    {"BLANK": -32768},
+    {"BLANK": 7, "BSCALE": 2.0, "BZERO": 100.0},
+    {"BLANK": 7, "BZERO": 32768},
+    {"BLANK": 0},
+    {"BZERO": 32768},
+    {},
+], ids=["blank", "blank-scaled", "blank-unsigned", "blank-zero", "unsigned", "plain"])
+@pytest.mark.parametrize("plane", [0, 1])
+def test_js9_stream_matches_astropy(tmp_path, cards, plane):
+    path = str(tmp_path / "frame.fits")
+    _write_raw(path, _raw_frame(), cards)
+    assert _streamed_js9(path, plane) == _astropy_js9(path, plane)
+
+
+def test_js9_stream_maps_blank_to_zero(tmp_path):
+    path = str(tmp_path / "frame.fits")
+    raw = _raw_frame()
+    _write_raw(path, raw, {"BLANK": -32768})
+    with fits.open(io.BytesIO(_streamed_js9(path))) as hdul:
+        data = hdul[0].data
+        assert "BLANK" not in hdul[0].header
+    assert (data[raw[0] == -32768] == 0.0).all()
+    assert (data[raw[0] != -32768] == raw[0][raw[0] != -32768]).all()
+
+
+@pytest.mark.parametrize("cards", [{"BLANK": 7}, {"BLANK": 7, "BSCALE": 0.5}, {"BLANK": 0, "BZERO": 10.0}])
+def test_js9_stream_compressed_matches_astropy(tmp_path, cards):
+    path = str(tmp_path / "frame.fits.fz")
+    _write_raw(path, _raw_frame(shape=(37, 29)), cards, compressed=True)
+    with fits.open(path) as hdul:
+        expected = np.nan_to_num(np.asarray(hdul[1].data, dtype=np.float32))
+    with fits.open(io.BytesIO(_streamed_js9(path))) as hdul:
+        np.testing.assert_array_equal(hdul[0].data, expected)
+
+
+def test_preview_blank_pixels_are_nan(tmp_path):
+    path = str(tmp_path / "frame.fits")
+    raw = _raw_frame(shape=(37, 29))
+    _write_raw(path, raw, {"BLANK": 7})
+    preview = read_fits_preview(path, 29, mode="stride")
+    assert preview.dtype == np.float32
+    np.testing.assert_array_equal(np.isnan(preview), raw == 7)
+
+
+def test_js9_stream_closes_plane_when_header_fails(tmp_path, monkeypatch):
+    import services.fits_service as fits_service
+    from services.fits_tiles import CompressedPlane
+
+    path = str(tmp_path / "frame.fits.fz")
+    _write_raw(path, _raw_frame(shape=(37, 29)), {}, compressed=True)
+    closed = []
+    real_close = CompressedPlane.close
+    monkeypatch.setattr(CompressedPlane, "close", lambda self: closed.append(self) or real_close(self))
+
+    def broken_header(hdr, shape):
+        raise ValueError("bad header")
+
+    monkeypatch.setattr(fits_service, "js9_safe_header", broken_header)
+    with pytest.raises(ValueError):
+        js9_safe_stream(path)
+    assert len(closed) == 1
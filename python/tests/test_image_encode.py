@@ -0,0 +1,17 @@
+import pytest
+
+from services.image_encode import _negotiate
+
+
+@pytest.mark.parametrize("accept, expected", [
+    ("image/webp,image/*,*/*;q=0.8", "webp"),
+    ("image/png;q=0", "webp"),
+    ("image/png;q=0, image/webp;q=0.5", "webp"),
+    ("image/png;q=0, image/webp;q=0, image/jpeg;q=0.1", "jpeg"),
+    ("image/*, image/png;q=0", "webp"),
+    ("text/html", "png"),
+    ("*/*;q=0", None),
+    (None, None),
+])
+def test_negotiate(accept, expected):
+    assert _negotiate(accept) == expected
@@ -0,0 +1,20 @@
+import json
+
+from routers import image
+
+
+def test_header_cache_is_bounded_by_bytes(monkeypatch):
+    monkeypatch.setattr(image, "_HEADERS", type(image._HEADERS)())
+    monkeypatch.setattr(image, "_HEADERS_BYTES", 0)
+    payload = {"exif": {"MakerNote": "x" * 1000}}
+    size = len(json.dumps(payload))
+    monkeypatch.setattr(image, "HEADER_CACHE_BYTES", 3 * size)
+
+    for i in range(5):
+        image._cache_header((f"/img{i}.jpg", 1, 1), payload)
+    assert list(image._HEADERS) == [(f"/img{i}.jpg", 1, 1) for i in (2, 3, 4)]
+    assert image._HEADERS_BYTES == 3 * size
+
+    image._cache_header(("/huge.jpg", 1, 1), {"exif": {"MakerNote": "x" * 4000}})
+    assert ("/huge.jpg", 1, 1) not in image._HEADERS
+    assert image._HEADERS_BYTES == 3 * size
@@ -0,0 +1,91 @@
+import struct
+
+import pytest
+from exifread import process_file
+
+from services.raw_exif import read_raw_exif
+
+_ASCII, _SHORT, _LONG, _RATIONAL = 2, 3, 4, 5
+_EXIF_OFFSET = 0x8769
+
+
+def _entry_data(endian: str, typ: int, value) -> bytes:
+    if typ == _ASCII:
+        return value.encode("ascii") + b"\0"
+    if typ == _RATIONAL:
+        return struct.pack(f"{endian}II", *value)
+    return struct.pack(endian + ("H" if typ == _SHORT else "I"), value)
+
+
+def _tiff(endian: str, ifd0: list, exif: list, ifd1: list, gap: int = 0) -> bytes:
+    """
+    A TIFF-based RAW layout: IFD0 (→ EXIF IFD, next → IFD1), the EXIF IFD, then
+    `gap` bytes of image data and IFD1. Entries are (tag, type, value), sorted by tag.
+    """
+    def size(entries):
+        data = (len(_entry_data(endian, t, v)) for _, t, v in entries)
+        return 2 + 12 * len(entries) + 4 + sum(n for n in data if n > 4)
+
+    ifd0 = sorted(ifd0 + [(_EXIF_OFFSET, _LONG, 0)])
+    at0 = 8
+    at_exif = at0 + size(ifd0)
+    at1 = at_exif + size(exif) + gap
+    ifd0 = [(tag, t, at_exif if tag == _EXIF_OFFSET else v) for tag, t, v in ifd0]
+
+    def ifd(at, entries, next_ifd):
+        head, data = struct.pack(f"{endian}H", len(entries)), b""
+        data_at = at + 2 + 12 * len(entries) + 4
+        for tag, t, v in entries:
+            raw = _entry_data(endian, t, v)
+            count = len(raw) if t == _ASCII else 1
+            if len(raw) <= 4:
+                head += struct.pack(f"{endian}HHI", tag, t, count) + raw.ljust(4, b"\0")
+            else:
+                head += struct.pack(f"{endian}HHII", tag, t, count, data_at + len(data))
+                data += raw
+        return head + struct.pack(f"{endian}I", next_ifd) + data
+
+    magic = (b"II" if endian == "<" else b"MM") + struct.pack(f"{endian}HI", 42, at0)
+    return (magic + ifd(at0, ifd0, at1) + ifd(at_exif, exif, 0)
+            + b"\0" * gap + ifd(at1, ifd1, 0))
+
+
+def _sample_raw(endian: str, gap: int = 0) -> bytes:
+    ifd0 = [
+        (256, _LONG, 6048), (257, _LONG, 4024),
+        (271, _ASCII, "NIKON CORPORATION"), (272, _ASCII, "NIKON D850"),
+        (306, _ASCII, "2024:05:06 07:08:09"),
+    ]
+    exif = [
+        (0x829A, _RATIONAL, (1, 250)), (0x829D, _RATIONAL, (28, 10)), (0x8827, _SHORT, 800),
+        (0x9003, _ASCII, "2024:05:06 22:10:11"), (0x920A, _RATIONAL, (500, 10)),
+    ]
+    ifd1 = [(256, _LONG, 160), (257, _LONG, 120), (259, _SHORT, 6)]
+    return _tiff(endian, ifd0, exif, ifd1, gap)
+
+
+def _as_text(tags: dict) -> dict:
+    return {k: str(v) for k, v in tags.items()}
+
+
+@pytest.mark.parametrize("ext", [".nef", ".cr2", ".dng"])
+@pytest.mark.parametrize("endian", ["<", ">"], ids=["II", "MM"])
+def test_bounded_read_matches_process_file(tmp_path, ext, endian):
+    path = tmp_path / f"sample{ext}"
+    path.write_bytes(_sample_raw(endian, gap=3 * 1024 * 1024))
+    with open(path, "rb") as f:
+        reference = _as_text(process_file(f, details=False, extract_thumbnail=False))
+
+    fast = _as_text(read_raw_exif(path))
+    assert fast == {k: v for k, v in reference.items() if k.startswith(("Image ", "EXIF "))}
+    assert fast["EXIF ExposureTime"] == "1/250"
+    assert fast["Image Model"] == "NIKON D850"
+    assert any(k.startswith("Thumbnail ") for k in reference)
+
+    assert _as_text(read_raw_exif(path, full=True)) == reference
+
+
+def test_unrecognised_file_gives_no_tags(tmp_path):
+    path = tmp_path / "junk.nef"
+    path.write_bytes(b"\0" * 4096)
+    assert read_raw_exif(path) == {}
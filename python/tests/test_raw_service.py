@@ -0,0 +1,27 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from services.raw_service import bayer_histograms
+
+
+def _fake_raw(mosaic: np.ndarray):
+    # RGGB: R at (0, 0), G at (0, 1) and (1, 0), B at (1, 1)
+    return SimpleNamespace(raw_pattern=np.array([[0, 1], [3, 2]]), color_desc=b"RGBG",
+                           raw_image_visible=mosaic)
+
+
+@pytest.mark.parametrize("shape", [(6, 8), (7, 9), (1, 5), (5, 1)])
+def test_bayer_histograms_count_every_pixel(shape):
+    rng = np.random.default_rng(0)
+    mosaic = rng.integers(0, 4096, size=shape, dtype=np.uint16)
+    counts = bayer_histograms(_fake_raw(mosaic))
+
+    assert counts.sum() == mosaic.size
+    expected = {0: mosaic[0::2, 0::2], 2: mosaic[1::2, 1::2]}
+    for c, plane in expected.items():
+        assert counts[c].sum() == plane.size
+        assert (counts[c] == np.bincount(plane.ravel(), minlength=1 << 16)).all()
+    green = np.concatenate([mosaic[0::2, 1::2].ravel(), mosaic[1::2, 0::2].ravel()])
+    assert (counts[1] == np.bincount(green, minlength=1 << 16)).all()
@@ -0,0 +1,61 @@
+import numpy as np
+import tifffile
+
+from services import stf
+from services.tiff_service import open_tiff_as_image
+
+
+def test_stf_stats_are_keyed_on_the_source_read(tmp_path):
+    path = str(tmp_path / "frame.tif")
+    rng = np.random.default_rng(3)
+    tifffile.imwrite(path, rng.integers(0, 4096, size=(300, 400), dtype=np.uint16), rowsperstrip=16)
+
+    open_tiff_as_image(path, 50, "stf")     # stride-sampled read
+    open_tiff_as_image(path, 400, "stf")    # full page through Pillow
+    sources = {dict(key[4]).get("source") for key in stf._STATS if key[0] == path}
+    assert sources == {"strided8", "pillow"}
+
+
+def _halves(path: str, w: int = 50) -> tuple:
+    """Mean RGB of the left and right halves of the `w`-wide thumbnail of `path`."""
+    rgb = np.asarray(open_tiff_as_image(path, w), dtype=np.float64)
+    half = rgb.shape[1] // 2
+    return rgb[:, :half - 2].mean(axis=(0, 1)), rgb[:, half + 2:].mean(axis=(0, 1))
+
+
+def test_palette_tiff_is_shown_through_its_colormap(tmp_path):
+    path = str(tmp_path / "palette.tif")
+    index = np.zeros((300, 400), dtype=np.uint8)
+    index[:, 200:] = 1
+    colormap = np.zeros((3, 256), dtype=np.uint16)
+    colormap[:, 0] = (65535, 0, 0)      # red
+    colormap[:, 1] = (0, 0, 65535)      # blue
+    tifffile.imwrite(path, index, photometric="palette", colormap=colormap, rowsperstrip=16)
+
+    left, right = _halves(path)
+    assert np.allclose(left, (255, 0, 0), atol=2)
+    assert np.allclose(right, (0, 0, 255), atol=2)
+
+
+def test_cmyk_tiff_is_converted_to_rgb(tmp_path):
+    path = str(tmp_path / "cmyk.tif")
+    cmyk = np.zeros((300, 400, 4), dtype=np.uint8)
+    cmyk[:, :200] = (0, 255, 255, 0)    # red
+    cmyk[:, 200:] = (0, 0, 0, 255)      # black
+    tifffile.imwrite(path, cmyk, photometric="separated", rowsperstrip=16)
+
+    left, right = _halves(path)
+    assert np.allclose(left, (255, 0, 0), atol=2)
+    assert np.allclose(right, (0, 0, 0), atol=2)
+
+
+def test_miniswhite_tiff_is_inverted(tmp_path):
+    for dtype, top in ((np.uint8, 255), (np.uint16, 65535)):
+        path = str(tmp_path / f"miniswhite-{np.dtype(dtype).name}.tif")
+        data = np.zeros((300, 400), dtype=dtype)
+        data[:, 200:] = top
+        data[::7, ::7] = top // 2           # keeps the percentile stretch off a flat field
+        tifffile.imwrite(path, data, photometric="miniswhite", rowsperstrip=16)
+
+        left, right = _halves(path)
+        assert left.mean() > 200 and right.mean() < 55, (dtype, left, right)
@@ -291,13 +291,15 @@ final class SessionController extends AbstractController
 ): Response
 {
 
-    if ($exposure->getRawHeader() == null)
+    // Scans store RAW headers without the full EXIF dump: fetch it on first view
+    $isRaw = !in_array($exposure->getFormat(), ['FITS', 'TIF'], true);
+    if ($exposure->getRawHeader() == null || ($isRaw && !isset($exposure->getRawHeader()['EXIF'])))
     {
         $absPath = $this->resolver->toAbsolutePath($exposure->getPath());
         $headers = match ($exposure->getFormat()) {
             'FITS' => $astropy->fitsHeader($absPath),
             'TIF'  => $astropy->imageHeader($absPath),
-            default => $astropy->rawHeader($absPath),
+            default => $astropy->rawHeader($absPath, true),
         };
         $exposure->setRawHeader($headers);
         $entityManager->flush();
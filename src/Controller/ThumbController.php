@@ -25,14 +25,15 @@ final class ThumbController extends AbstractController
     ) {}
 
     #[Route('/thumbnail/{light}/{w}', name: 'thumbnail', methods: ['GET'])]
-    public function thumbnail(Exposure $light, int $w = 512): Response
+    public function thumbnail(Request $request, Exposure $light, int $w = 512): Response
     {
         $absPath = $this->resolver->toAbsolutePath($light->getPath());
-        $content = $this->astropy->fitsThumbnail($absPath, $w);
+        $thumb = $this->astropy->fitsThumbnail($absPath, $w, $this->thumbnailService->preferredFormat($request));
 
-        return new Response($content, 200, [
-            'Content-Type' => 'image/jpeg',
+        return new Response($thumb['content'], 200, [
+            'Content-Type' => $thumb['type'],
             'Cache-Control' => 'max-age=3600, public',
+            'Vary' => 'Accept',
         ]);
     }
 
@@ -40,9 +41,11 @@ final class ThumbController extends AbstractController
     public function exportThumbnail(Request $request, Export $export, int $w = 512): Response
     {
         $absPath = $this->resolver->toAbsolutePath($export->getPath());
+        $fmt = $this->thumbnailService->preferredFormat($request);
         return $this->thumbnailService->getCachedThumbnail(
             $request, $absPath, $w, 'fits',
-            fn () => $this->astropy->fitsThumbnail($absPath, $w),
+            fn () => $this->astropy->fitsThumbnail($absPath, $w, $fmt),
+            $fmt,
         );
     }
 
@@ -50,9 +53,11 @@ final class ThumbController extends AbstractController
     public function fitsThumbnail(Request $request, Exposure $light, int $w = 512): Response
     {
         $absPath = $this->resolver->toAbsolutePath($light->getPath());
+        $fmt = $this->thumbnailService->preferredFormat($request);
         return $this->thumbnailService->getCachedThumbnail(
             $request, $absPath, $w, 'fits',
-            fn () => $this->astropy->fitsThumbnail($absPath, $w),
+            fn () => $this->astropy->fitsThumbnail($absPath, $w, $fmt),
+            $fmt,
         );
     }
 
@@ -60,9 +65,11 @@ final class ThumbController extends AbstractController
     public function xisfThumbnail(Request $request, Master $master, int $w = 512): Response
     {
         $absPath = $this->resolver->toAbsolutePath($master->getPath());
+        $fmt = $this->thumbnailService->preferredFormat($request);
         return $this->thumbnailService->getCachedThumbnail(
             $request, $absPath, $w, 'xisf',
-            fn () => $this->astropy->xisfThumbnail($absPath, $w),
+            fn () => $this->astropy->xisfThumbnail($absPath, $w, $fmt),
+            $fmt,
         );
     }
 
@@ -70,9 +77,11 @@ final class ThumbController extends AbstractController
     public function imageThumbnail(Request $request, Export $export, int $w = 512): Response
     {
         $absPath = $this->resolver->toAbsolutePath($export->getPath());
+        $fmt = $this->thumbnailService->preferredFormat($request);
         return $this->thumbnailService->getCachedThumbnail(
             $request, $absPath, $w, 'images',
-            fn () => $this->astropy->imageThumbnail($absPath, $w),
+            fn () => $this->astropy->imageThumbnail($absPath, $w, $fmt),
+            $fmt,
         );
     }
 
@@ -80,9 +89,11 @@ final class ThumbController extends AbstractController
     public function tifThumbnail(Request $request, Export $export, int $w = 512): Response
     {
         $absPath = $this->resolver->toAbsolutePath($export->getPath());
+        $fmt = $this->thumbnailService->preferredFormat($request);
         return $this->thumbnailService->getCachedThumbnail(
             $request, $absPath, $w, 'tif',
-            fn () => $this->astropy->tifThumbnail($absPath, $w),
+            fn () => $this->astropy->tifThumbnail($absPath, $w, $fmt),
+            $fmt,
         );
     }
 
@@ -90,9 +101,11 @@ final class ThumbController extends AbstractController
     public function tifMasterThumbnail(Request $request, Master $master, int $w = 512): Response
     {
         $absPath = $this->resolver->toAbsolutePath($master->getPath());
+        $fmt = $this->thumbnailService->preferredFormat($request);
         return $this->thumbnailService->getCachedThumbnail(
             $request, $absPath, $w, 'tif',
-            fn () => $this->astropy->tifThumbnail($absPath, $w),
+            fn () => $this->astropy->tifThumbnail($absPath, $w, $fmt),
+            $fmt,
         );
     }
 
@@ -100,9 +113,11 @@ final class ThumbController extends AbstractController
     public function tifExposureThumbnail(Request $request, Exposure $exposure, int $w = 512): Response
     {
         $absPath = $this->resolver->toAbsolutePath($exposure->getPath());
+        $fmt = $this->thumbnailService->preferredFormat($request);
         return $this->thumbnailService->getCachedThumbnail(
             $request, $absPath, $w, 'tif',
-            fn () => $this->astropy->tifThumbnail($absPath, $w),
+            fn () => $this->astropy->tifThumbnail($absPath, $w, $fmt),
+            $fmt,
         );
     }
 
@@ -141,9 +156,11 @@ final class ThumbController extends AbstractController
     public function rawThumbnail(Request $request, Exposure $exposure, int $w = 512): Response
     {
         $absPath = $this->resolver->toAbsolutePath($exposure->getPath());
+        $fmt = $this->thumbnailService->preferredFormat($request);
         return $this->thumbnailService->getCachedThumbnail(
             $request, $absPath, $w, 'raw',
-            fn () => $this->astropy->rawThumbnail($absPath, $w),
+            fn () => $this->astropy->rawThumbnail($absPath, $w, $fmt),
+            $fmt,
         );
     }
 }
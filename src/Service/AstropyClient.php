@@ -14,6 +14,28 @@ class AstropyClient
         return rtrim($this->baseUrl, '/') . $path;
     }
 
+    /**
+     * Fetch a rendered thumbnail. $fmt (png|jpeg|webp) picks the encoding; without it
+     * the service answers PNG. Returns the bytes with the media type they were sent as.
+     *
+     * @return array{content: string, type: string}
+     */
+    private function thumbnail(string $endpoint, string $path, int $w, ?string $fmt): array
+    {
+        $query = ['path' => $path, 'w' => $w];
+        if ($fmt !== null) {
+            $query['fmt'] = $fmt;
+        }
+        $resp = $this->client->request('GET', $this->url($endpoint), [
+            'query'   => $query,
+            'timeout' => self::DEFAULT_TIMEOUT,
+        ]);
+        $content = $resp->getContent();
+        $type = $resp->getHeaders()['content-type'][0] ?? 'image/png';
+
+        return ['content' => $content, 'type' => $type];
+    }
+
     public function forecast(float $lat, float $lon): string
     {
         $resp = $this->client->request('GET', $this->url('/astro/forecast'), [
@@ -23,13 +45,12 @@ class AstropyClient
         return $resp->getContent();
     }
 
-    public function fitsThumbnail(string $path, int $w = 512): string
+    /**
+     * @return array{content: string, type: string}
+     */
+    public function fitsThumbnail(string $path, int $w = 512, ?string $fmt = null): array
     {
-        $resp = $this->client->request('GET', $this->url('/fits/thumbnail'), [
-            'query'   => ['path' => $path, 'w' => $w],
-            'timeout' => self::DEFAULT_TIMEOUT,
-        ]);
-        return $resp->getContent();
+        return $this->thumbnail('/fits/thumbnail', $path, $w, $fmt);
     }
 
     public function fitsHeader(string $path): array
@@ -41,22 +62,24 @@ class AstropyClient
         return $resp->toArray(false);
     }
 
-    public function rawHeader(string $path): array
+    /**
+     * Normalised RAW header fields; $exif adds the full EXIF tag dump under 'EXIF'.
+     */
+    public function rawHeader(string $path, bool $exif = false): array
     {
         $resp = $this->client->request('GET', $this->url('/raw/header'), [
-            'query'   => ['path' => $path],
+            'query'   => ['path' => $path, 'exif' => $exif ? 'true' : 'false'],
             'timeout' => self::DEFAULT_TIMEOUT,
         ]);
         return $resp->toArray(false);
     }
 
-    public function xisfThumbnail(string $path, int $w = 512): string
+    /**
+     * @return array{content: string, type: string}
+     */
+    public function xisfThumbnail(string $path, int $w = 512, ?string $fmt = null): array
     {
-        $resp = $this->client->request('GET', $this->url('/xisf/thumbnail'), [
-            'query'   => ['path' => $path, 'w' => $w],
-            'timeout' => self::DEFAULT_TIMEOUT,
-        ]);
-        return $resp->getContent();
+        return $this->thumbnail('/xisf/thumbnail', $path, $w, $fmt);
     }
 
     public function xisfHeader(string $path): array
@@ -73,13 +96,12 @@ class AstropyClient
         return $respA;
     }
 
-    public function imageThumbnail(string $path, int $w = 512): string
+    /**
+     * @return array{content: string, type: string}
+     */
+    public function imageThumbnail(string $path, int $w = 512, ?string $fmt = null): array
     {
-        $resp = $this->client->request('GET', $this->url('/image/thumbnail'), [
-            'query'   => ['path' => $path, 'w' => $w],
-            'timeout' => self::DEFAULT_TIMEOUT,
-        ]);
-        return $resp->getContent();
+        return $this->thumbnail('/image/thumbnail', $path, $w, $fmt);
     }
 
     public function imageHeader(string $path): array
@@ -91,22 +113,20 @@ class AstropyClient
         return $resp->toArray(false);
     }
 
-    public function tifThumbnail(string $path, int $w = 512): string
+    /**
+     * @return array{content: string, type: string}
+     */
+    public function tifThumbnail(string $path, int $w = 512, ?string $fmt = null): array
     {
-        $resp = $this->client->request('GET', $this->url('/tif/thumbnail'), [
-            'query'   => ['path' => $path, 'w' => $w],
-            'timeout' => self::DEFAULT_TIMEOUT,
-        ]);
-        return $resp->getContent();
+        return $this->thumbnail('/tif/thumbnail', $path, $w, $fmt);
     }
 
-    public function rawThumbnail(string $path, int $w = 512): string
+    /**
+     * @return array{content: string, type: string}
+     */
+    public function rawThumbnail(string $path, int $w = 512, ?string $fmt = null): array
     {
-        $resp = $this->client->request('GET', $this->url('/raw/thumbnail'), [
-            'query'   => ['path' => $path, 'w' => $w],
-            'timeout' => self::DEFAULT_TIMEOUT,
-        ]);
-        return $resp->getContent();
+        return $this->thumbnail('/raw/thumbnail', $path, $w, $fmt);
     }
 
     public function rawHistogram(string $path): array
@@ -2,6 +2,7 @@
 
 namespace App\Service;
 
+use Symfony\Component\HttpFoundation\AcceptHeader;
 use Symfony\Component\HttpFoundation\BinaryFileResponse;
 use Symfony\Component\HttpFoundation\Request;
 use Symfony\Component\HttpFoundation\Response;
@@ -17,10 +18,29 @@ class ThumbnailService
         $this->cacheRoot = rtrim($kernel->getProjectDir(), '/').'/var/cache/thumbs';
     }
 
+    /** cache file extension → media type */
+    private const TYPES = ['png' => 'image/png', 'webp' => 'image/webp', 'jpg' => 'image/jpeg'];
+
+    /**
+     * Encoding to ask the render service for: WebP when the client lists it, else PNG.
+     * Only explicitly listed WebP counts (q=0 refuses it); wildcards keep the PNG default.
+     */
+    public function preferredFormat(Request $request): string
+    {
+        foreach (AcceptHeader::fromString($request->headers->get('Accept'))->all() as $item) {
+            if (strtolower($item->getValue()) === 'image/webp') {
+                return $item->getQuality() > 0 ? 'webp' : 'png';
+            }
+        }
+
+        return 'png';
+    }
+
     /**
      * Serve a cached thumbnail, generating it on-miss via $generator.
      *
-     * @param callable $generator fn() => string (raw image bytes)
+     * @param callable $generator fn() => array{content: string, type: string} (encoded
+     *                            bytes and the media type the render service sent)
      */
     public function getCachedThumbnail(
         Request $request,
@@ -28,18 +48,30 @@ class ThumbnailService
         int $width,
         string $cacheSubDir,
         callable $generator,
+        string $format = 'png',
     ): Response {
         $mtime = @filemtime($sourcePath) ?: 0;
-        $hash = sha1($sourcePath.'|w='.$width.'|m='.$mtime);
+        $hash = sha1($sourcePath.'|w='.$width.'|m='.$mtime.'|f='.$format);
         $cacheDir = $this->cacheRoot.'/'.$cacheSubDir.'/'.$width;
-        $cacheFile = $cacheDir.'/'.$hash.'.png';
 
         if (!is_dir($cacheDir)) {
             @mkdir($cacheDir, 0775, true);
         }
 
-        if (!is_file($cacheFile)) {
-            $content = $generator();
+        // the extension records the type the service actually answered with
+        $cacheFile = null;
+        foreach (array_keys(self::TYPES) as $ext) {
+            if (is_file($cacheDir.'/'.$hash.'.'.$ext)) {
+                $cacheFile = $cacheDir.'/'.$hash.'.'.$ext;
+                break;
+            }
+        }
+
+        if ($cacheFile === null) {
+            ['content' => $content, 'type' => $type] = $generator();
+            $type = strtolower(trim(explode(';', $type)[0]));
+            $ext = array_search($type, self::TYPES, true) ?: 'png';
+            $cacheFile = $cacheDir.'/'.$hash.'.'.$ext;
             $tmp = $cacheFile.'.tmp.'.bin2hex(random_bytes(6));
             file_put_contents($tmp, $content, LOCK_EX);
             @rename($tmp, $cacheFile);
@@ -47,7 +79,8 @@ class ThumbnailService
         }
 
         $response = new BinaryFileResponse($cacheFile);
-        $response->headers->set('Content-Type', 'image/png');
+        $response->headers->set('Content-Type', self::TYPES[pathinfo($cacheFile, PATHINFO_EXTENSION)]);
+        $response->setVary('Accept');
         $response->setContentDisposition(ResponseHeaderBag::DISPOSITION_INLINE);
         $response->setPublic();
         $response->setMaxAge(86400);